@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+"""
+Micro-benchmark of the per-message cost of decoding PUB messages:
+ - parsing: a Component built for every message, as in the original hot paths, against the cached parsers
+ - dict decoding: MessageToDict against the generated decoders, after checking that both give
+   the same dict for every message defined in protos/
+    python bench/decode.py [-n ITERATIONS]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib.logging import lincoln
+from lib.decrypt import Component, parser, decode, messages
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.descriptor import FieldDescriptor
+from lib.generator_hex import decide_pb2 as dc_pb, peckboard_pb2 as pb_pb, \
+    sound_alsa_pb2 as sa_pb, house_light_pb2 as hl_pb, stepper_motor_pb2 as sm_pb
+
+SAMPLES = [
+    ('peck-keys', pb_pb.KeyState(peck_left=True)),
+    ('peck-leds-center', pb_pb.LedState(led_state='blue')),
+    ('audio-playback', sa_pb.SaState(audio_id='song_a', playback=True, frame_count=88200)),
+    ('house-light', hl_pb.HlState(manual=False, dyson=True, brightness=42, daytime=True)),
+    ('stepper-motor', sm_pb.SmState(running=True, direction=True)),
+]
+
+
+def pub_bytes(state):
+    pub = dc_pb.Pub()
+    pub.time.GetCurrentTime()
+    pub.state.Pack(state)
+    return pub.SerializeToString()
+
+
+async def per_message(messages, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        for comp, msg in messages:
+            await Component('state', comp).from_pub(msg)
+    return (time.perf_counter() - start) / (n * len(messages))
+
+
+def cached(messages, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        for comp, msg in messages:
+            parser('state', comp).from_pub(msg)
+    return (time.perf_counter() - start) / (n * len(messages))
+
+
+def populated(message_class):
+    """
+    Instance of a message with every plain scalar field set away from its default
+    """
+    message = message_class()
+    for field in message_class.DESCRIPTOR.fields:
+        if field.label == FieldDescriptor.LABEL_REPEATED or field.message_type is not None:
+            continue
+        if field.type == FieldDescriptor.TYPE_BOOL:
+            setattr(message, field.name, True)
+        elif field.type == FieldDescriptor.TYPE_STRING:
+            setattr(message, field.name, 'stimulus.wav')
+        elif field.type == FieldDescriptor.TYPE_BYTES:
+            setattr(message, field.name, b'\x00\x01')
+        elif field.type in (FieldDescriptor.TYPE_FLOAT, FieldDescriptor.TYPE_DOUBLE):
+            setattr(message, field.name, 0.25)
+        elif field.type == FieldDescriptor.TYPE_ENUM:
+            setattr(message, field.name, field.enum_type.values[-1].number)
+        else:
+            setattr(message, field.name, 2**31 - 1)
+    return message
+
+
+def check_equivalence():
+    """
+    Compare the generated decoders with MessageToDict for every message in protos/
+    """
+    classes = list(messages.values()) + [getattr(dc_pb, name) for name in dc_pb.DESCRIPTOR.message_types_by_name]
+    for message_class in classes:
+        for message in [message_class(), populated(message_class)]:
+            expected = MessageToDict(message,
+                                     including_default_value_fields=True,
+                                     preserving_proto_field_name=True)
+            assert decode(message) == expected, \
+                f"{message_class.__name__}: decoded {decode(message)}, MessageToDict gives {expected}"
+    print(f"Decoders match MessageToDict for all {len(classes)} messages")
+
+
+def to_dict(states, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        for _comp, state in states:
+            MessageToDict(state, including_default_value_fields=True, preserving_proto_field_name=True)
+    slow = (time.perf_counter() - start) / (n * len(states))
+    start = time.perf_counter()
+    for _ in range(n):
+        for _comp, state in states:
+            decode(state)
+    fast = (time.perf_counter() - start) / (n * len(states))
+    return slow, fast
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('-n', type=int, default=20000, help="iterations over the sample messages")
+    args = p.parse_args()
+    messages = [(comp, pub_bytes(state)) for comp, state in SAMPLES]
+    before = asyncio.run(per_message(messages, args.n))
+    after = cached(messages, args.n)
+    print(f"Component per message: {before * 1e6:8.2f} us/msg")
+    print(f"cached parser:         {after * 1e6:8.2f} us/msg  ({before / after:.1f}x)")
+    check_equivalence()
+    slow, fast = to_dict(SAMPLES, args.n)
+    print(f"MessageToDict:         {slow * 1e6:8.2f} us/msg")
+    print(f"generated decoder:     {fast * 1e6:8.2f} us/msg  ({slow / fast:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+"""
+Replay a PUB capture (see PUB_CAPTURE in docs/deployment.md) through the event pipeline of a Sauron,
+i.e. the scry dispatcher and the collector decoding events for Decide-Host, and report how fast it kept up:
+    python bench/replay.py CAPTURE [--speed X | --fast] [--profile]
+Nothing is posted to Decide-Host unless CONTACT_HOST is set in config.yml.
+"""
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib.logging import lincoln
+from lib.dispatch import Sauron
+from lib.capture import Palantir
+from lib import metrics
+
+
+async def replay(path, speed):
+    messenger = Sauron(capture=None)
+    eye = asyncio.create_task(messenger.eye())
+    palantir = Palantir(path, speed)
+    start = time.perf_counter()
+    replayed = await palantir.replay(messenger)
+    while not (messenger.collected.empty() and messenger.scried.empty()):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    print(f"Replayed {replayed} frames in {elapsed:.3f}s, {replayed / elapsed:.0f} frames/s")
+    for name, stats in metrics.snapshot()['pipeline'].items():
+        print(f"{name:12s} {stats}")
+    eye.cancel()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Replay a PUB capture")
+    p.add_argument('capture')
+    p.add_argument('--speed', type=float, default=1.0, help="replay speed relative to the capture")
+    p.add_argument('--fast', action='store_true', help="replay as fast as possible")
+    p.add_argument('--profile', action='store_true', help="print the functions taking the most time")
+    p.add_argument('--log_level', default='WARNING')
+    args = p.parse_args()
+    lincoln(log="replay.log", level=args.log_level)
+    speed = None if args.fast else args.speed
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.runcall(asyncio.run, replay(args.capture, speed))
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+    else:
+        asyncio.run(replay(args.capture, speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+"""
+Simulated decide-rs, to run the scripts, load tests and benchmarks without a box:
+    python bench/simulate.py [--latency S] [--jitter S] [--peck_rate HZ] [--pecks FILE]
+It binds the REQ_ENDPOINT and PUB_ENDPOINT of config.yml unless given others.
+Scripted pecks are read from a JSON list of [seconds from start, key] pairs, e.g. [[1.5, "peck_center"]]
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib.config import REQ_ENDPOINT, PUB_ENDPOINT
+from lib.logging import lincoln
+from lib.simulator import Simulator
+
+
+def main():
+    p = argparse.ArgumentParser(description="Simulate decide-rs")
+    p.add_argument('--req_endpoint', default=REQ_ENDPOINT)
+    p.add_argument('--pub_endpoint', default=PUB_ENDPOINT)
+    p.add_argument('--latency', type=float, default=0.0, help="seconds replies and state changes are delayed by")
+    p.add_argument('--jitter', type=float, default=0.0, help="seconds of uniformly random delay added to latency")
+    p.add_argument('--sample_rate', type=int, default=44100)
+    p.add_argument('--stim_duration', type=float, default=2.0,
+                   help="seconds a stimulus plays for when its wav file isn't found")
+    p.add_argument('--load_time', type=float, default=0.02,
+                   help="seconds taken per stimulus to load a stimuli config")
+    p.add_argument('--concurrent', action='store_true',
+                   help="handle requests concurrently, rather than one at a time as decide-rs does")
+    p.add_argument('--pecks', help="JSON file of scripted pecks")
+    p.add_argument('--peck_rate', type=float, default=0.0, help="random pecks per second")
+    p.add_argument('--seed', type=int)
+    p.add_argument('--log_level', default='INFO')
+    args = p.parse_args()
+    lincoln(log="simulator.log", level=args.log_level)
+    pecks = None
+    if args.pecks:
+        with open(args.pecks) as file:
+            pecks = [tuple(peck) for peck in json.load(file)]
+    simulator = Simulator(args.req_endpoint, args.pub_endpoint, latency=args.latency, jitter=args.jitter,
+                          sample_rate=args.sample_rate, stim_duration=args.stim_duration, load_time=args.load_time,
+                          pecks=pecks, peck_rate=args.peck_rate, seed=args.seed, serial=not args.concurrent)
+    try:
+        asyncio.run(simulator.run())
+    except KeyboardInterrupt:
+        logging.getLogger('main').info(f"Simulator stopped, {simulator.stats()}")
+
+
+if __name__ == '__main__':
+    main()
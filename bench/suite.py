@@ -0,0 +1,412 @@
+#!/usr/bin/python3
+"""
+Benchmarks of the client's hot paths, each timed over several rounds of many operations:
+    python bench/suite.py [--only NAME ...] [--rounds N] [--scale X] [--output FILE]
+Results are written as JSON, to bench/results/<time>.json unless given --output. With --compare, the run
+is checked against an earlier one and the suite fails if any benchmark lost more throughput, or gained more
+latency, than the thresholds allow:
+    python bench/suite.py --compare bench/results/baseline.json [--throughput 0.1] [--latency 0.2]
+Two saved runs are compared without running anything with --compare BASELINE --against RESULTS.
+Throughput is operations per second of the median round, latency the p50 and p90 time per operation
+across rounds. With --allocations, the memory each operation allocates on top of what it started with,
+peak included, is measured with tracemalloc and checked against --memory. Only what a benchmark brackets
+with begin() and end() is timed and measured, its setup is left out.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+import zmq
+import zmq.asyncio
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib.config import BATCH_SIZE
+from lib.logging import lincoln
+from lib.rig import Rig
+from lib.decrypt import Component, parser, decode
+from lib.dispatch import Request, Sauron
+from lib.process import Morgoth, JukeBox
+from lib.report import handle_and_respond, make_response
+from lib.inform import stamp, idempotency_key
+from google.protobuf.json_format import MessageToDict
+from lib.generator_hex import decide_pb2 as dc_pb, peckboard_pb2 as pb_pb, \
+    sound_alsa_pb2 as sa_pb, house_light_pb2 as hl_pb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger('main')
+
+# name -> (coroutine function taking a number of operations and returning the seconds they took,
+#          default number of operations per round)
+benchmarks = {}
+# bytes allocated at the peak of each timed section since allocations were last measured, see end()
+peaks = []
+traced = 0
+
+
+def benchmark(name, operations):
+    def register(fn):
+        benchmarks[name] = (fn, operations)
+        return fn
+    return register
+
+
+def begin():
+    """
+    Start the timed section of a benchmark, once its setup is done
+    :return: start time, for end()
+    """
+    global traced
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        traced = tracemalloc.get_traced_memory()[0]
+    return time.perf_counter()
+
+
+def end(start):
+    """
+    End the timed section begun at start. While allocations are measured, the peak allocated within the section,
+    beyond what was allocated as it began, is added to peaks
+    :return: seconds the section took
+    """
+    elapsed = time.perf_counter() - start
+    if tracemalloc.is_tracing():
+        peaks.append(tracemalloc.get_traced_memory()[1] - traced)
+    return elapsed
+
+
+def pub_bytes(state):
+    pub = dc_pb.Pub()
+    pub.time.GetCurrentTime()
+    pub.state.Pack(state)
+    return pub.SerializeToString()
+
+
+PUBS = [
+    ('peck-keys', pub_bytes(pb_pb.KeyState(peck_left=True))),
+    ('peck-leds-center', pub_bytes(pb_pb.LedState(led_state='blue'))),
+    ('audio-playback', pub_bytes(sa_pb.SaState(audio_id='song_a', playback=True, frame_count=88200))),
+    ('house-light', pub_bytes(hl_pb.HlState(manual=False, dyson=True, brightness=42, daytime=True))),
+]
+
+
+@benchmark('request_spawn', 5000)
+async def request_spawn(n):
+    start = begin()
+    for i in range(n):
+        await Request.spawn('ChangeState', 'peck-leds-left', {'led_state': 'blue'})
+    return end(start)
+
+
+@benchmark('request_encode', 5000)
+async def request_encode(n):
+    start = begin()
+    for i in range(n):
+        Request.encode('ChangeState', 'peck-leds-left', {'led_state': 'blue'})
+    return end(start)
+
+
+@benchmark('request_cached', 50000)
+async def request_cached(n):
+    """
+    Requests as Sauron.command gets them, i.e. the few distinct ones of a session from the command cache
+    """
+    bodies = [('ChangeState', 'peck-leds-left', {'led_state': 'off'}),
+              ('ChangeState', 'peck-leds-left', {'led_state': 'blue'}),
+              ('ChangeState', 'stepper-motor', {'running': True, 'direction': True}),
+              ('ChangeState', 'audio-playback', {'playback': 0}),
+              ('ChangeState', 'house-light', {'manual': False, 'dyson': True})]
+    start = begin()
+    for i in range(n):
+        Request.cached(*bodies[i % len(bodies)])
+    return end(start)
+
+
+@benchmark('component_from_pub_to_dict', 5000)
+async def component_from_pub_to_dict(n):
+    start = begin()
+    for i in range(n):
+        comp, msg = PUBS[i % len(PUBS)]
+        _time, state = await Component('state', comp).from_pub(msg)
+        MessageToDict(state, including_default_value_fields=True, preserving_proto_field_name=True)
+    return end(start)
+
+
+@benchmark('parser_from_pub_decode', 20000)
+async def parser_from_pub_decode(n):
+    start = begin()
+    for i in range(n):
+        comp, msg = PUBS[i % len(PUBS)]
+        _time, state = parser('state', comp).from_pub(msg)
+        decode(state)
+    return end(start)
+
+
+morgoth = None
+
+
+@benchmark('scry_predicate', 20000)
+async def scry_predicate(n):
+    """
+    PUB messages through the scry dispatcher, tested by a few pending scrys until the last one matches
+    """
+    global morgoth
+    if morgoth is None:
+        morgoth = Morgoth(Sauron())
+    messenger = morgoth.messenger
+    miss = pub_bytes(pb_pb.KeyState(peck_right=True))
+    hit = pub_bytes(pb_pb.KeyState(peck_left=True, peck_center=True))
+    scrys = [asyncio.create_task(morgoth.scry('peck-keys', condition, raw=raw)) for condition, raw in [
+        ({'peck_left': True, 'peck_center': True}, False),
+        (lambda keys: keys.peck_left and keys.peck_center, True),
+        (lambda keys: keys['peck_left'] and keys['peck_center'], False),
+    ]]
+    await asyncio.sleep(0)
+    start = begin()
+    for i in range(n):
+        while messenger.scried.full():
+            await asyncio.sleep(0)
+        messenger.scried.offer(('state', 'peck-keys', hit if i == n - 1 else miss, time.time()))
+    await asyncio.gather(*scrys)
+    return end(start)
+
+
+receiver = None
+
+
+@benchmark('pub_receive', 20000)
+async def pub_receive(n):
+    """
+    PUB messages from a socket through the reader, decoded by the collector and offered to the scry dispatcher
+    """
+    global receiver
+    if receiver is None:
+        publisher = zmq.asyncio.Context.instance().socket(zmq.PUB)
+        publisher.bind('inproc://bench-pub')
+        messenger = Sauron(Rig(req_endpoint='inproc://bench-req', pub_endpoint='inproc://bench-pub'), capture=None)
+        asyncio.create_task(messenger.eye())
+        await asyncio.sleep(0.1)  # for the subscription to reach the publisher
+        receiver = (publisher, messenger)
+    publisher, messenger = receiver
+    received = messenger.collected.received
+    start = begin()
+    for i in range(0, n, 100):  # in chunks, to stay clear of the high water marks
+        chunk = min(n - i, 100)
+        for _ in range(chunk):
+            await publisher.send_multipart([b'state/peck-keys', PUBS[0][1]])
+        received += chunk
+        while messenger.collected.received < received:
+            await asyncio.sleep(0)
+    return end(start)
+
+
+playlist = None
+
+
+def playlist_config(stimuli=500, frequency=20):
+    """
+    Experiment config with a playlist of stimuli * frequency plays
+    """
+    global playlist
+    if playlist is None:
+        cfg = {'parameters': {}, 'stimulus_root': '/tmp', 'stimuli': [{
+            'name': f"stim_{i}",
+            'frequency': frequency,
+            'responses': {'peck_left': {'p_reward': 1.0, 'correct': True},
+                          'peck_right': {'p_punish': 1.0, 'correct': False},
+                          'timeout': {'correct': False}},
+        } for i in range(stimuli)]}
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as file:
+            json.dump(cfg, file)
+        playlist = file.name
+        atexit.register(os.remove, playlist)
+    return playlist
+
+
+@benchmark('jukebox_spawn', 5)
+async def jukebox_spawn(n):
+    cfg = playlist_config()
+    start = begin()
+    for i in range(n):
+        await JukeBox.spawn(cfg)
+    return end(start)
+
+
+@benchmark('jukebox_next', 20000)
+async def jukebox_next(n):
+    jukebox = await JukeBox.spawn(playlist_config())
+    start = begin()
+    for i in range(n):
+        jukebox.next()
+    return end(start)
+
+
+@benchmark('log_format', 20000)
+async def log_format(n):
+    formatter = next(handler.formatter for handler in logger.handlers if type(handler) is logging.StreamHandler)
+    record = logger.makeRecord('main', logging.STATE, __file__, 0, "Scry finished for %s", (['peck-keys'],), None)
+    start = begin()
+    for i in range(n):
+        formatter.format(record)
+    return end(start)
+
+
+@benchmark('report_respond', 2000)
+async def report_respond(n):
+    loop = asyncio.get_running_loop()
+    variables = {'state': {'trial': 120, 'result': 'feed', 'response': 'peck_left', 'rtime': 0.52},
+                 'params': {'response_duration': 4000, 'feed_duration': 4000, 'init_key': 'peck_center'}}
+    query = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    elapsed = 0.0
+    for i in range(n):
+        client, server = socket.socketpair()
+        server.setblocking(False)
+        client.sendall(query)
+        start = begin()
+        await handle_and_respond(server, None, make_response, dict(variables), loop)
+        elapsed += end(start)
+        client.close()
+    return elapsed
+
+
+def events(n):
+    return [{'name': 'peck-keys', 'state': {'peck_left': True, 'peck_center': False, 'peck_right': False},
+             'time': 1700000000.0 + i} for i in range(n)]
+
+
+@benchmark('inform_batch', 100)
+async def inform_batch(n):
+    """
+    Stamping and serializing batches of events as the Courier posts them, per batch
+    """
+    batches = [events(BATCH_SIZE) for _ in range(n)]
+    start = begin()
+    for batch in batches:
+        for msg in batch:
+            stamp(msg, 'bench')
+        json.dumps(batch)
+    return end(start)
+
+
+@benchmark('idempotency_key', 20000)
+async def idempotency_keys(n):
+    records = [stamp(msg, 'bench') for msg in events(n)]
+    start = begin()
+    for msg in records:
+        idempotency_key(msg)
+    return end(start)
+
+
+async def allocated(fn, operations=200):
+    """
+    :return: mean bytes allocated at the peak of single operations, beyond what was allocated before each.
+             Only the timed section counts, not the benchmark's setup
+    """
+    peaks.clear()
+    tracemalloc.start()
+    for _ in range(operations):
+        await fn(1)
+    tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+
+async def measure(names, rounds, scale, allocations=False):
+    results = {}
+    for name in names:
+        fn, operations = benchmarks[name]
+        n = max(int(operations * scale), 1)
+        await fn(max(n // 10, 1))  # warm up caches and lazily built objects
+        per_op = sorted([await fn(n) / n for _ in range(rounds)])
+        results[name] = {
+            'operations': n,
+            'rounds': rounds,
+            'throughput': 1 / statistics.median(per_op),
+            'p50_us': statistics.median(per_op) * 1e6,
+            'p90_us': per_op[min(int(0.9 * rounds), rounds - 1)] * 1e6,
+        }
+        line = (f"{name:28s} {results[name]['throughput']:12.0f} ops/s"
+                f" {results[name]['p50_us']:10.2f} us p50 {results[name]['p90_us']:10.2f} us p90")
+        if allocations:
+            results[name]['alloc_bytes'] = await allocated(fn)
+            line += f" {results[name]['alloc_bytes']:10.0f} B/op"
+        print(line)
+    return results
+
+
+def compare(baseline, results, throughput, latency, memory):
+    """
+    :param throughput: largest fraction of throughput a benchmark may lose
+    :param latency: largest fraction of latency a benchmark may gain
+    :param memory: largest fraction of allocated bytes a benchmark may gain, if both runs measured them
+    :return: list of regressions found, as str
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:28s} not in baseline")
+            continue
+        change = result['throughput'] / before['throughput'] - 1
+        line = f"{name:28s} throughput {change:+7.1%}"
+        if change < -throughput:
+            regressions.append(f"{name} throughput fell {-change:.1%}, over the {throughput:.0%} allowed")
+        for stat in ['p50_us', 'p90_us']:
+            change = result[stat] / before[stat] - 1
+            line += f"  {stat[:3]} {change:+7.1%}"
+            if change > latency:
+                regressions.append(f"{name} {stat[:3]} latency rose {change:.1%}, over the {latency:.0%} allowed")
+        if ('alloc_bytes' in result) and ('alloc_bytes' in before):
+            change = result['alloc_bytes'] / before['alloc_bytes'] - 1
+            line += f"  alloc {change:+7.1%}"
+            if change > memory:
+                regressions.append(f"{name} allocations rose {change:.1%}, over the {memory:.0%} allowed")
+        print(line)
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the client's hot paths")
+    p.add_argument('--only', nargs='+', choices=list(benchmarks), help="benchmarks to run, defaults to all")
+    p.add_argument('--rounds', type=int, default=7)
+    p.add_argument('--scale', type=float, default=1.0, help="multiplier of every benchmark's operations per round")
+    p.add_argument('--output', help="JSON file to write the results to")
+    p.add_argument('--compare', help="JSON results of an earlier run to check this one against")
+    p.add_argument('--against', help="JSON results to compare instead of running the benchmarks")
+    p.add_argument('--throughput', type=float, default=0.10, help="largest fraction of throughput that may be lost")
+    p.add_argument('--latency', type=float, default=0.20, help="largest fraction of latency that may be gained")
+    p.add_argument('--allocations', action='store_true', help="also measure the memory each operation allocates")
+    p.add_argument('--memory', type=float, default=0.20, help="largest fraction of allocations that may be gained")
+    args = p.parse_args()
+
+    if args.against:
+        with open(args.against) as file:
+            results = json.load(file)['results']
+    else:
+        lincoln(log="bench.log", level='WARNING')
+        results = asyncio.run(measure(args.only or list(benchmarks), args.rounds, args.scale, args.allocations))
+        output = args.output or os.path.join(HERE, 'results', f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as file:
+            json.dump({'time': time.time(), 'python': platform.python_version(), 'machine': platform.node(),
+                       'results': results}, file, indent=4)
+        print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(baseline, results, args.throughput, args.latency, args.memory)
+        if regressions:
+            print("\n".join(regressions))
+            sys.exit(f"{len(regressions)} regressions against {args.compare}")
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ from lib.dispatch import *
 from lib.process import *
 from lib.logging import lincoln
 from lib.report import set_server
+from lib.rig import supervised, current
+from lib.vigil import run
 __name__ = 'gng'
 
 p = argparse.ArgumentParser()
@@ -71,12 +73,9 @@ async def await_init():
     logger.state("Awaiting init")
     await_input = peck_parse(params['init_key'], 'r')
 
-    def peck_init(key_msg):
-        if (await_input in key_msg) and (key_msg[await_input]):
-            return True
     await decider.scry(
         'peck-keys',
-        condition=peck_init,
+        condition={await_input: True},
     )
 
 
@@ -96,18 +95,20 @@ async def await_response(stim_data, correction):
     response = 'timeout'
     logger.debug(stim_data)
 
-    def resp_check(pub_msg):
+    def resp_check(key_state):
         nonlocal response
-        for k, v in pub_msg.items():
-            if (k in stim_data['responses']) and bool(v):
+        for k in stim_data['responses']:
+            if getattr(key_state, k, False):
                 response = k
                 return True
         return False
 
-    _, responded, _, rtime = await decider.scry(
+    _, responded, _, rtime, *_ = await decider.scry(
         'peck-keys',
         condition=resp_check,
-        timeout=params['response_duration']
+        timeout=params['response_duration'],
+        raw=True,
+        since=decider.playback.ended
     )
 
     if not responded:
@@ -183,13 +184,16 @@ async def main():
     decider = Morgoth()
     await contact_host()
 
-    await decider.set_light()
-    await decider.set_feeder(duration=params['feed_duration'])
+    await asyncio.gather(
+        decider.set_light(),
+        decider.set_feeder(duration=params['feed_duration']),
+    )
+    # decide-rs answers one request at a time, and parsing the stimuli config takes a while
     await decider.init_playback(args.config, replace=args.replace)
 
     logger.info(f"{__name__} initiated")
     if not args.no_notify:
-        slack(f"{__name__} initiated on {IDENTITY}", usr=args.user)
+        slack(f"{__name__} initiated on {current().identity}", usr=args.user)
 
     try:
         await asyncio.gather(
@@ -199,21 +203,19 @@ async def main():
             return_exceptions=False
         )
     except Exception as error:
-        import traceback
-        logger.error(f"Error encountered: {error}")
-        print(traceback.format_exc())
+        logger.exception(f"Error encountered: {error}")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client encountered an error and will shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client encountered an error and will shut down.", usr=args.user)
         sys.exit("Error Detected, shutting down.")
 
 
-if __name__ == "gng":
+if (__name__ == "gng") and not supervised():
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.warning("Keyboard Interrupt Detected, shutting down.")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client was manually shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client was manually shut down.", usr=args.user)
         sys.exit("Keyboard Interrupt Detected, shutting down.")
 
 
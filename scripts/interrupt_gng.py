@@ -8,6 +8,8 @@ from lib.logging import lincoln
 from lib.process import *
 from lib.dispatch import *
 from lib.report import set_server
+from lib.rig import supervised, current
+from lib.vigil import run
 
 __name__ = 'interrupt-gng'
 
@@ -58,12 +60,9 @@ async def await_init():
     logger.state("Awaiting Init")
     await_input = peck_parse(params['init_key'], 'r')
 
-    def peck_init(key_state):
-        if (await_input in key_state) and (key_state[await_input]):
-            return True
     await decider.scry(
         'peck-keys',
-        condition=peck_init,
+        condition={await_input: True},
     )
 
 
@@ -95,9 +94,10 @@ async def await_response(stim_data):
                     return True
         return False
 
-    _, _, _, rtime = await decider.scry(['peck-keys','audio-playback'],
-                                        condition=resp_check,
-                                        timeout=duration or params['response_duration'])
+    _, _, _, rtime, *_ = await decider.scry(['peck-keys','audio-playback'],
+                                            condition=resp_check,
+                                            timeout=duration or params['response_duration'],
+                                            since=decider.playback.started)
 
     if response != 'timeout':
         await decider.stop()
@@ -151,13 +151,16 @@ async def main():
     # Start logging for messages
     await contact_host()
     # Initialize components
-    await decider.set_light()
-    await decider.set_feeder(duration=params['feed_duration'])
+    await asyncio.gather(
+        decider.set_light(),
+        decider.set_feeder(duration=params['feed_duration']),
+    )
+    # decide-rs answers one request at a time, and parsing the stimuli config takes a while
     await decider.init_playback(args.config, replace=args.replace)
 
     logger.info(f"{__name__} is initiated")
     if not args.no_notify:
-        slack(f"{__name__} was initiated on {IDENTITY}", usr=args.user)
+        slack(f"{__name__} was initiated on {current().identity}", usr=args.user)
 
     try:
         await asyncio.gather(
@@ -167,20 +170,18 @@ async def main():
             return_exceptions=False
         )
     except Exception as error:
-        import traceback
-        logger.error(f"Error encountered: {error}")
-        print(traceback.format_exc())
+        logger.exception(f"Error encountered: {error}")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client encountered an error and will shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client encountered an error and will shut down.", usr=args.user)
         sys.exit("Error Detected, shutting down.")
 
 
-if __name__ == "interrupt-gng":
+if (__name__ == "interrupt-gng") and not supervised():
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.warning("Keyboard Interrupt Detected, shutting down.")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client was manually shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client was manually shut down.", usr=args.user)
         sys.exit("Keyboard Interrupt Detected, shutting down.")
 
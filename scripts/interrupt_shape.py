@@ -8,6 +8,8 @@ from lib.logging import lincoln
 from lib.process import *
 from lib.dispatch import *
 from lib.report import set_server
+from lib.rig import supervised, current
+from lib.vigil import run
 __name__ = 'interrupt-shape'
 
 p = argparse.ArgumentParser()
@@ -59,12 +61,14 @@ async def main():
     decider = Morgoth()
     await contact_host()
 
-    await decider.set_light()
-    await decider.set_feeder(duration=params['feed_duration'])
+    await asyncio.gather(
+        decider.set_light(),
+        decider.set_feeder(duration=params['feed_duration']),
+    )
 
     logger.info(f"{__name__} is initiated")
     if not args.no_notify:
-        slack(f"{__name__} was initiated on {IDENTITY}", usr=args.user)
+        slack(f"{__name__} was initiated on {current().identity}", usr=args.user)
 
     try:
         await asyncio.gather(
@@ -74,11 +78,9 @@ async def main():
             return_exceptions=False
         )
     except Exception as error:
-        import traceback
-        logger.error(f"Error encountered: {error}")
-        print(traceback.format_exc())
+        logger.exception(f"Error encountered: {error}")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client encountered an error and will shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client encountered an error and will shut down.", usr=args.user)
         sys.exit("Error Detected, shutting down.")
 
 
@@ -145,17 +147,12 @@ async def block1_patience():
         await decider.set_feeder(feed_duration)
         logger.info(f"Entering block {state['block']}")
 
-    await decider.cue(cue_pos, params['cue_color'])
+    cued = await decider.cue(cue_pos, params['cue_color'])
 
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
-
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=params['response_duration'])
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={await_input: True},
+                                                        timeout=params['response_duration'],
+                                                        since=cued)
 
     # feed regardless of response
     await decider.cue(cue_pos, 'off')
@@ -199,17 +196,12 @@ async def block2_peck():
         logger.info(f"Entering block {state['block']}")
         await decider.set_feeder(params['feed_duration'])
 
-    await decider.cue(cue_pos, params['cue_color'])
-
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
+    cued = await decider.cue(cue_pos, params['cue_color'])
 
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=None)
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={await_input: True},
+                                                        timeout=None,
+                                                        since=cued)
 
     # feed regardless of response
     await decider.cue(await_input, 'off')
@@ -244,15 +236,9 @@ async def block3_auton():
         logger.info(f"Entering block {state['block']}")
         await decider.cues_off()
 
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
-
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=None)
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={await_input: True},
+                                                        timeout=None)
 
     # feed regardless of response
     if responded:  # should always be True in this block
@@ -276,11 +262,11 @@ async def block3_auton():
         raise Exception("Block 3 passed without any response!")
 
 
-if __name__ == 'interrupt-shape':
+if (__name__ == 'interrupt-shape') and not supervised():
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.warning("Keyboard Interrupt Detected, shutting down.")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client was manually shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client was manually shut down.", usr=args.user)
         sys.exit("Keyboard Interrupt Detected, shutting down.")
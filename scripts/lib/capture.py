@@ -0,0 +1,115 @@
+import time
+import struct
+import atexit
+import asyncio
+import logging
+from pathlib import Path
+
+logger = logging.getLogger('main')
+
+# A capture file starts with MAGIC, followed by one record per PUB frame: RECORD, i.e. the host time
+# the frame was received (s, float64), topic length (uint16) and message length (uint32), then the
+# topic and the serialized Pub message as received. All little-endian.
+MAGIC = b"PYCRUST-PUB-CAPTURE-1\n"
+RECORD = struct.Struct('<dHI')
+
+
+class Capture:
+    """
+    Appends every PUB frame received to a capture file, for replay with Palantir. Writes are buffered,
+    so capturing costs the reader a few microseconds per frame; the buffer is flushed at exit.
+    """
+    def __init__(self, path):
+        """
+        :param path: str, capture file, appended to if it exists
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.frames = 0
+        self.bytes = 0
+        atexit.register(self.close)
+        logger.info(f"Capturing PUB stream to {self.path}")
+
+    def write(self, topic, msg, received):
+        """
+        :param topic: bytes, PUB topic frame
+        :param msg: bytes, serialized Pub message
+        :param received: host time (s) the frame was received
+        """
+        self.file.write(RECORD.pack(received, len(topic), len(msg)) + topic + msg)
+        self.frames += 1
+        self.bytes += RECORD.size + len(topic) + len(msg)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def stats(self):
+        return {'path': str(self.path), 'frames': self.frames, 'bytes': self.bytes}
+
+
+def frames(path):
+    """
+    Read a capture file. A record cut short, as the last one of a capture that was killed may be, ends it.
+    :return: generator of (received, topic, msg)
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a PUB capture")
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            received, topic_length, msg_length = RECORD.unpack(header)
+            topic = file.read(topic_length)
+            msg = file.read(msg_length)
+            if len(msg) < msg_length:
+                logger.warning(f"Capture {path} ends with a truncated record")
+                return
+            yield received, topic, msg
+
+
+class Palantir:
+    """
+    Replays a capture into a Sauron, as if its frames were arriving from decide-rs again.
+    Frames go through the same fan-out as live ones, so scrys, the light cycle and event logging see them.
+    Each frame is stamped with the time it was recorded as received, shifted by one offset so that the first
+    frame is received now: the intervals between frames, and so the estimate of decide-rs' clock, are those
+    of the capture whatever the replay speed.
+    """
+    def __init__(self, path, speed=1.0):
+        """
+        :param path: str, capture file
+        :param speed: float, replay speed relative to the capture, e.g. 2 for twice as fast,
+                      None for as fast as possible
+        """
+        self.path = path
+        self.speed = speed
+        self.replayed = 0
+
+    async def replay(self, messenger):
+        """
+        Feed every frame of the capture to messenger
+        :param messenger: Sauron, left unconnected to decide-rs or not
+        :return: int, frames replayed
+        """
+        loop = asyncio.get_running_loop()
+        logger.info(f"Replaying {self.path} at " + (f"{self.speed}x" if self.speed else "full speed"))
+        messenger.wake()
+        start = None
+        for received, topic, msg in frames(self.path):
+            if start is None:
+                start = (received, loop.time())
+                shift = time.time() - received
+            if self.speed:
+                await asyncio.sleep(max(start[1] + (received - start[0]) / self.speed - loop.time(), 0))
+            else:
+                # let the consumers take each frame before the next, rather than overflowing their queues
+                await asyncio.sleep(0)
+            messenger.take(topic, msg, received + shift)
+            self.replayed += 1
+        logger.info(f"Replayed {self.replayed} frames from {self.path}")
+        return self.replayed
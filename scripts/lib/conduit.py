@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+logger = logging.getLogger('main')
+
+POLICIES = ['block', 'drop_oldest', 'spill']
+
+
+class Conduit(asyncio.Queue):
+    """
+    Bounded queue between two pipeline stages, keeping count of what it could not hold.
+    When full, the policy decides what happens to the next item:
+        block: the producer waits for room (only through push(); offer() never waits)
+        drop_oldest: the oldest queued item is discarded to make room
+        spill: the new item is handed to the spill function, usually written to disk
+    """
+    def __init__(self, name, maxsize, policy='drop_oldest', spill=None):
+        super().__init__(maxsize=maxsize)
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy} for {name}, expected one of {POLICIES}")
+        if (policy == 'spill') and (spill is None):
+            raise ValueError(f"Overflow policy 'spill' for {name} requires a spill function")
+        self.name = name
+        self.policy = policy
+        self.spill = spill
+        self.received = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.overflows = 0
+        self.high_water = 0
+
+    def offer(self, item):
+        """
+        Put an item without ever waiting. A 'block' conduit that is full falls back to
+        dropping its oldest item, as the producer (i.e. the PUB reader) must not stall.
+        """
+        self.received += 1
+        if self.full():
+            self._overflow()
+            if self.policy == 'spill':
+                self._spill(item)
+                return
+            self.get_nowait()
+            self.dropped += 1
+        self.put_nowait(item)
+        self.high_water = max(self.high_water, self.qsize())
+
+    async def push(self, item):
+        """
+        Put an item, applying the overflow policy when full.
+        """
+        if self.policy != 'block':
+            self.offer(item)
+            return
+        self.received += 1
+        if self.full():
+            self._overflow()
+        await self.put(item)
+        self.high_water = max(self.high_water, self.qsize())
+
+    def stats(self):
+        return {
+            'depth': self.qsize(),
+            'high_water': self.high_water,
+            'received': self.received,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'overflows': self.overflows,
+        }
+
+    def _overflow(self):
+        self.overflows += 1
+        # warn on the first overflow and then sparingly, overflows come in bursts
+        if self.overflows & (self.overflows - 1) == 0:
+            logger.warning(f"{self.name} queue full ({self.maxsize}), applying '{self.policy}' policy."
+                           f" {self.overflows} overflows so far")
+
+    def _spill(self, item):
+        try:
+            self.spill(item)
+            self.spilled += 1
+        except OSError as e:
+            self.dropped += 1
+            logger.error(f"{self.name} could not spill overflowing item: {e}")
@@ -18,4 +18,22 @@ CONTACT_HOST = config['CONTACT_HOST']
 PORT_CTRL = config['PORT_CTRL']
 HIVEMIND = config['HOST_ADDR']
 IDENTITY = os.uname()[1]
-HOST_LOG = None
\ No newline at end of file
+HOST_LOG = None
+QUEUE_SIZE = config.get('QUEUE_SIZE', 512)
+EVENT_POLICY = config.get('EVENT_POLICY', 'block')
+BATCH_SIZE = config.get('BATCH_SIZE', 64)
+BATCH_DEADLINE = config.get('BATCH_DEADLINE', 1.0)
+SPOOL_SYNC = config.get('SPOOL_SYNC', 32)
+SPOOL_COMPACT = config.get('SPOOL_COMPACT', 4 * 2**20)
+REPLAY_CONCURRENCY = config.get('REPLAY_CONCURRENCY', 4)
+REPLAY_RATE = config.get('REPLAY_RATE', 20)
+REQUEST_RETRIES = config.get('REQUEST_RETRIES', 3)
+RETRY_BACKOFF = config.get('RETRY_BACKOFF', 0.05)
+RECONNECT_BACKOFF = config.get('RECONNECT_BACKOFF', 0.1)
+RECONNECT_MAX = config.get('RECONNECT_MAX', 5.0)
+REPORT_INTERVAL = config.get('REPORT_INTERVAL', 5.0)
+WORKER_GRACE = config.get('WORKER_GRACE', 30.0)
+PUB_CAPTURE = config.get('PUB_CAPTURE', None)
+EVENT_LOOP = config.get('EVENT_LOOP', 'asyncio')
+LAG_INTERVAL = config.get('LAG_INTERVAL', 0.05)
+BLOCK_THRESHOLD = config.get('BLOCK_THRESHOLD', 0.1)
@@ -2,42 +2,176 @@ from .generator_hex import decide_pb2 as dc_pb,\
     peckboard_pb2 as pb_pb, stepper_motor_pb2 as sm_pb, \
     sound_alsa_pb2 as sa_pb, house_light_pb2 as hl_pb
 import google.protobuf.any_pb2 as _any
+from google.protobuf.descriptor import FieldDescriptor as _fd
+from google.protobuf.json_format import MessageToDict
+import sys
+import keyword
 import logging
 
 logger = logging.getLogger('main')
 
 
+def type_url(message_class):
+    """
+    Google's default type_url convention, used by decide-rs to tag the contents of Any messages
+    """
+    return f"type.googleapis.com/{message_class.DESCRIPTOR.full_name}"
+
+
+# type_url -> protobuf message class, for every message in the generated component modules
+messages = {type_url(getattr(module, name)): getattr(module, name)
+            for module in [pb_pb, sm_pb, sa_pb, hl_pb]
+            for name in module.DESCRIPTOR.message_types_by_name}
+# JSON mapping of proto3 renders 64-bit integers as strings
+_STRINGIFIED = {_fd.TYPE_INT64, _fd.TYPE_UINT64, _fd.TYPE_SINT64, _fd.TYPE_FIXED64, _fd.TYPE_SFIXED64}
+_PLAIN = {_fd.TYPE_BOOL, _fd.TYPE_STRING, _fd.TYPE_INT32, _fd.TYPE_UINT32, _fd.TYPE_SINT32,
+          _fd.TYPE_FIXED32, _fd.TYPE_SFIXED32} | _STRINGIFIED
+
+
+def compile_decoder(message_class):
+    """
+    Build a function turning a parsed message into the same dict as
+    MessageToDict(message, including_default_value_fields=True, preserving_proto_field_name=True)
+    Messages with only plain scalar fields, i.e. all of our component states and params, get a
+    generated function reading each field directly. Anything else falls back to MessageToDict.
+    """
+    fields = message_class.DESCRIPTOR.fields
+    plain = all((field.type in _PLAIN)
+                and (field.label != _fd.LABEL_REPEATED)
+                and (field.containing_oneof is None)  # also covers proto3 optional fields
+                and not keyword.iskeyword(field.name)
+                for field in fields)
+    if not plain:
+        return lambda message: MessageToDict(message,
+                                             including_default_value_fields=True,
+                                             preserving_proto_field_name=True)
+    items = ", ".join(f"'{field.name}': str(m.{field.name})" if field.type in _STRINGIFIED
+                      else f"'{field.name}': m.{field.name}"
+                      for field in fields)
+    namespace = {}
+    exec(f"def decode(m):\n    return {{{items}}}\n", namespace)
+    return namespace['decode']
+
+
+# protobuf message class -> dict decoder
+decoders = {message_class: compile_decoder(message_class) for message_class in messages.values()}
+
+
+def decode(message):
+    """
+    Decode a parsed component message into a dict with its field names and defaults
+    """
+    try:
+        return decoders[message.__class__](message)
+    except KeyError:
+        decoders[message.__class__] = compile_decoder(message.__class__)
+        return decoders[message.__class__](message)
+
+
+# component name -> {'state': message class, 'param': message class}
+registry = {}
+# (meta_type, component name) -> Parser, created on first use
+parsers = {}
+# PUB topic -> (meta_type, component name), so that the reader looks a topic up rather than decoding and splitting it.
+# Only state topics: the registry has no message for what components publish on their error and log topics
+_topics = {}
+
+
+def register(component, state, params):
+    """
+    Make a component known to py_crust
+    :param component: str, name of the component in decide-rs' config and PUB topics
+    :param state: name of the component's state message in its proto file
+    :param params: name of the component's parameters message in its proto file
+    """
+    by_name = {cls.DESCRIPTOR.name: cls for cls in messages.values()}
+    registry[component] = {'state': by_name[state], 'param': by_name[params]}
+    _topics[f"state/{component}".encode('utf-8')] = (sys.intern('state'), sys.intern(component))
+
+
+register("house-light", state="HlState", params="HlParams")
+register("stepper-motor", state="SmState", params="SmParams")
+register("peck-keys", state="KeyState", params="KeyParams")
+register("audio-playback", state="SaState", params="SaParams")
+for _led in ["peck-leds-left", "peck-leds-right", "peck-leds-center"]:
+    register(_led, state="LedState", params="LedParams")
+
+
+def read_topic(topic: bytes):
+    """
+    :param topic: PUB topic, e.g. b'state/peck-keys'
+    :return: (meta_type, component name), None for any topic but the state of a registered component
+    """
+    return _topics.get(topic)
+
+
+def parser(meta_type: str, component: str):
+    """
+    Reusable parser for a component's state or param messages, e.g. from the PUB topic 'state/peck-keys'
+    """
+    try:
+        return parsers[meta_type, component]
+    except KeyError:
+        parsers[meta_type, component] = Parser(meta_type, component)
+        return parsers[meta_type, component]
+
+
+class Parser:
+    """
+    Parses every message for one component and meta-type into the same protobuf instances.
+    A parsed message is only valid until the parser's next call, so decode it before awaiting anything.
+    """
+    __slots__ = ('name', 'meta_type', 'type_url', 'data', 'pub')
+
+    def __init__(self, meta_type: str, component: str):
+        if component not in registry:
+            logger.error(f"Unrecognized/Unspecified Component Name {component}")
+            raise ValueError(f"Unrecognized/Unspecified Component Name {component}")
+        message_class = registry[component][meta_type]
+        self.name = component
+        self.meta_type = meta_type
+        self.type_url = type_url(message_class)
+        self.data = message_class()
+        self.pub = dc_pb.Pub()
+        logger.proto(f"{component} - {meta_type} - protobuf parser created")
+
+    def from_any(self, any_msg: _any.Any):
+        if any_msg.type_url == self.type_url:
+            self.data.ParseFromString(any_msg.value)
+            return self.data
+        else:
+            logger.error(f" Mismatching type_urls, got {any_msg.type_url} expected {self.type_url}")
+
+    def from_pub(self, msg):
+        self.pub.ParseFromString(msg)
+        return self.pub.time, self.from_any(self.pub.state)
+
+
 class Component:
     def __init__(self, meta_type: str, component=None, data=None):
         self.name = component
         self.meta_type = meta_type
-        if component == "house-light":
-            self.component = self.HouseLight(meta_type, data)
-        elif component in ["peck-leds-left", "peck-leds-right", "peck-leds-center"]:
-            self.component = self.PeckLed(meta_type, data)
-        elif component == "stepper-motor":
-            self.component = self.StepperMotor(meta_type, data)
-        elif component == "peck-keys":
-            self.component = self.PeckKeys(meta_type, data)
-        elif component == "audio-playback":
-            self.component = self.SoundAlsa(meta_type, data)
-        else:
+        if component not in registry:
             logger.error(f"Unrecognized/Unspecified Component Name {component}")
-        logger.proto(f"{component} - {meta_type} - protobuf parser created")
-        
+            raise ValueError(f"Unrecognized/Unspecified Component Name {component}")
+        message_class = registry[component][meta_type]
+        self.type_url = type_url(message_class)
+        self.data = message_class(**data) if data else message_class()
+        logger.proto(f"{component} - {meta_type} - protobuf message created")
+
     async def from_any(self, any_msg: _any.Any):
-        if any_msg.type_url == self.component.type_url:
+        if any_msg.type_url == self.type_url:
             any_string = any_msg.value
-            res = self.component.data.ParseFromString(any_string)
+            res = self.data.ParseFromString(any_string)
             logger.proto(f"{self.name} - {self.meta_type} - parsed Any message")
-            return self.component.data
+            return self.data
         else:
-            logger.error(f" Mismatching type_urls, got {any_msg.type_url} expected {self.component.type_url}")
+            logger.error(f" Mismatching type_urls, got {any_msg.type_url} expected {self.type_url}")
 
     async def to_any(self):
         any_msg = _any.Any()
-        any_msg.type_url = self.component.type_url
-        any_msg.Pack(self.component.data)
+        any_msg.type_url = self.type_url
+        any_msg.Pack(self.data)
         logger.proto(f"{self.name} - {self.meta_type} - packed Any message.")
         return any_msg
 
@@ -61,57 +195,3 @@ class Component:
             return req_msg
         else:
             logger.error(f"Invalid meta-type {self.meta_type} for Component request to be formed")
-
-    class HouseLight:
-
-        def __init__(self, meta_type: str, data=None):
-            if meta_type == "state":
-                self.type_url = "type.googleapis.com/HlState"
-                self.data = hl_pb.HlState(**data) if data else hl_pb.HlState()
-            elif meta_type == "param":
-                self.type_url = "type.googleapis.com/HlParams"
-                self.data = hl_pb.HlParams(**data) if data else hl_pb.HlParams()
-
-    class PeckKeys:
-
-        def __init__(self, meta_type: str, data=None):
-            self.meta_type = meta_type
-            if meta_type == "state":
-                self.type_url = "type.googleapis.com/KeyState"
-                self.data = pb_pb.KeyState(**data) if data else pb_pb.KeyState()
-            elif meta_type == "param":
-                self.type_url = "type.googleapis.com/KeyParams"
-                self.data = pb_pb.KeyParams()
-
-    class PeckLed:
-
-        def __init__(self, meta_type: str, data=None):
-            self.meta_type = meta_type
-            if meta_type == "state":
-                self.type_url = "type.googleapis.com/LedState"
-                self.data = pb_pb.LedState(**data) if data else pb_pb.LedState()
-            elif meta_type == "param":
-                self.type_url = "type.googleapis.com/LedParams"
-                self.data = pb_pb.LedParams()
-
-    class SoundAlsa:
-
-        def __init__(self, meta_type: str, data=None):
-            self.meta_type = meta_type
-            if meta_type == "state":
-                self.type_url = "type.googleapis.com/SaState"
-                self.data = sa_pb.SaState(**data) if data else sa_pb.SaState()
-            elif meta_type == "param":
-                self.type_url = "type.googleapis.com/SaParams"
-                self.data = sa_pb.SaParams(**data) if data else sa_pb.SaParams()
-
-    class StepperMotor:
-
-        def __init__(self, meta_type: str, data=None):
-            self.meta_type = meta_type
-            if meta_type == "state":
-                self.type_url = "type.googleapis.com/SmState"
-                self.data = sm_pb.SmState(**data) if data else sm_pb.SmState()
-            elif meta_type == "param":
-                self.type_url = "type.googleapis.com/SmParams"
-                self.data = sm_pb.SmParams(**data) if data else sm_pb.SmParams()
@@ -1,151 +1,723 @@
 import zmq
 import asyncio
+import itertools
+import functools
+import collections
 import zmq.asyncio
+from zmq.utils.monitor import recv_monitor_message
 from enum import Enum
+from pathlib import Path
 from .inform import *
-from .decrypt import Component
+from .conduit import Conduit
+from . import rig as rigs
+from . import metrics
+from . import latency
+from .capture import Capture
+from .decrypt import Component, parser, decode, read_topic
+from .errata import rep_err
 from .generator_hex import decide_pb2 as dc_db
-from google.protobuf.json_format import MessageToDict
 logger = logging.getLogger('main')
 
+# Requests that can be resent without changing the outcome: the caller of SetParameters verifies it
+IDEMPOTENT = ["GetState", "GetParameters", "SetParameters"]
+# PUB messages the reader takes in one go before letting the consumers run
+READ_BATCH = 64
+# Distinct requests kept serialized, see Request.cached()
+COMMAND_CACHE = 256
+# Names of socket monitor events
+EVENTS = {getattr(zmq, name): name for name in dir(zmq) if name.startswith('EVENT_')}
+
 
 class Sauron:
-    def __init__(self):
-        context = zmq.asyncio.Context()
-        # Collector logs every event to host
-        self.collector = context.socket(zmq.SUB)
-        self.collector.connect(PUB_ENDPOINT)
-        self.collector.subscribe(b"")
-        # SUB sockets aren't meant to dynamically subscribe/unsubscribe
-        # Therefore the scryer SUB socket must receive all messages first
-        self.scryer = context.socket(zmq.SUB)
-        self.scryer.connect(PUB_ENDPOINT)
-        self.scryer.subscribe(b"")
+    def __init__(self, rig=None, context=None, capture=PUB_CAPTURE):
+        """
+        :param rig: optional, Rig settings of the box, defaults to the current rig (see lib/rig.py)
+        :param context: optional, ZMQ context, defaults to the one shared by every instance in the process
+        :param capture: optional, file to append every PUB frame received to, see lib/capture.py.
+                        A rig run by the supervisor captures to a file of its own, suffixed with its name
+        """
+        self.rig = rig or rigs.current()
+        self.context = context or zmq.asyncio.Context.instance()
+        # A single SUB socket receives every PUB frame once,
+        # the reader task then fans each frame out to the consumer queues by topic
+        self.topics = [b""]
+        # Both sockets to decide-rs are monitored, see _heed()
+        self.subscriber, self.pong = self._dial('PUB')
+        for topic in self.topics:
+            self.subscriber.subscribe(topic)
+        self.reader = None
+        self.capture = None
+        if capture:
+            if self.rig.name is not None:
+                capture = Path(capture).with_name(f"{Path(capture).stem}_{self.rig.name}{Path(capture).suffix}")
+            self.capture = Capture(capture)
+            metrics.register('capture', self.capture.stats, rig=self.rig.name)
+        # Event logging runs as three stages: the reader receives, the collector decodes,
+        # and the uploader posts to host. Only the upload stage waits on the host,
+        # and what it does once the host falls behind is set by EVENT_POLICY.
+        # The reader never waits, so once a blocked upload stage backs up into the collector too,
+        # events are spilled there rather than dropped, unless the policy is to drop them
+        self.collected = Conduit('Collector', QUEUE_SIZE,
+                                 'drop_oldest' if EVENT_POLICY == 'drop_oldest' else 'spill', spill=self._spill)
+        self.uploads = Conduit('Uploader', QUEUE_SIZE, EVENT_POLICY,
+                               spill=lambda msg: log_dropped('events', stamp(msg, self.rig.identity)))
+        self.courier = Courier('events', identity=self.rig.identity)
+        metrics.register('pipeline', self.pressure, rig=self.rig.name)
+        metrics.register('latency', functools.partial(latency.snapshot, self.rig.name), rig=self.rig.name)
+        # Scry dispatcher, tests every message against the registry of pending waiters
+        self.scried = Conduit('Scry', QUEUE_SIZE)
+        self.waiters = {}
+        self.seer = None
+        # Last known state of each component, kept up to date by the reader
+        self.states = {}
+        # PUB topics skipped by the reader, each warned about once
+        self.unhandled = set()
+        # Last parameters set on each component, as (body, timeout), restored once decide-rs is back
+        self.parameters = {}
+        # Offset of decide-rs' clock from the host's, estimated by the collector
+        self.clock = Clock()
         # House-Light only updates
-        self.lighter = context.socket(zmq.SUB)
-        self.lighter.connect(PUB_ENDPOINT)
-        self.lighter.subscribe(b"state/house-light")
-        # REQ socket
-        self.caller = context.socket(zmq.REQ)
-        self.caller.connect(REQ_ENDPOINT)
-        # Monitor both REQ and PUB enpoints
-        self.ping = self.caller.get_monitor_socket()
-        self.pong = self.collector.get_monitor_socket()
-
-    async def command(self, request_type: str, component: str, body=None, timeout=TIMEOUT):
-        req = await Request.spawn(request_type, component, body)
-        message = [DECIDE_VERSION, req.type_encode, req.body]
-        if component is not None:
-            message.append(component.encode('utf-8'))
-        await self.caller.send_multipart(message)
+        self.lit = Conduit('House-Light', QUEUE_SIZE)
+        # DEALER socket, several requests may be in flight at once.
+        # Each request carries an id frame ahead of the empty delimiter, which decide-rs
+        # returns untouched as the reply envelope, so the reply can be matched to its caller
+        self.caller, self.ping = self._dial('REQ')
+        self.recycled = 0
+        metrics.register('commands', self.reliability, rig=self.rig.name)
+        self.pending = {}
+        self.request_ids = itertools.count()
+        self.answerer = None
+        # Once either socket disconnects, requests and scrys are paused
+        # until both sockets have been reconnected and the component states resynced
+        self.links = {'REQ': False, 'PUB': False}
+        self.linked = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.reconnecting = None
+        self.outages = 0
+        self.downtime = latency.Histogram(low=0.01, high=3600.0, per_octave=4)
+        metrics.register('connection', self.health, rig=self.rig.name)
+
+    def wake(self):
+        """
+        Start the PUB reader and scry dispatcher if they aren't running yet. Called by every consumer,
+        so that messages are read whether the Eye, a scry or the light cycle comes first.
+        """
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self._read())
+        if self.seer is None or self.seer.done():
+            self.seer = asyncio.create_task(self._divine())
+
+    def pressure(self):
+        """
+        Depth and overflow counters of every PUB consumer queue
+        """
+        conduits = [self.collected, self.uploads, self.lit, self.scried]
+        return {conduit.name: conduit.stats() for conduit in conduits}
+
+    def reliability(self):
+        """
+        Requests awaiting a reply, and times the command socket was replaced
+        """
+        return {'in_flight': len(self.pending), 'recycled': self.recycled}
+
+    def health(self):
+        """
+        Whether decide-rs is reachable, how often it was lost and for how long
+        """
+        return {'connected': self.ready.is_set(), 'outages': self.outages, 'downtime': self.downtime.stats()}
+
+    def last(self, comp):
+        """
+        :return: Reading of the component's last known state, None if it hasn't been heard from yet
+        """
+        return self.states.get(comp)
+
+    async def state(self, comp):
+        """
+        Current state of a component, from the PUB stream if it has been heard from, otherwise requested
+        """
+        reading = self.states.get(comp)
+        if reading is not None:
+            return reading.state
+        return await self.command(request_type="GetState", component=comp, body={})
+
+    async def resync(self, components=None, retries=None, wait=True):
+        """
+        Refresh the last known state of components with one parallel sweep of GetState requests
+        :param components: list of component names, defaults to every component heard from so far
+        :param retries: optional, see command()
+        :param wait: bool, see command()
+        :return: list of the decoded states, None for any that went unanswered
+        """
+        components = list(self.states) if components is None else components
+        logger.dispatch(f"Resyncing state of {components}")
+        return await asyncio.gather(*[self.command(request_type="GetState", component=comp, body={},
+                                                   retries=retries, wait=wait)
+                                      for comp in components])
+
+    def watch(self, components, predicate, deadline=None, current=False):
+        """
+        Register a waiter for the next PUB message from any of the components that satisfies predicate
+        :param components: list of component names
+        :param predicate: fn, takes the parsed protobuf message, returns True on a match
+        :param deadline: optional, event loop time after which the waiter is no longer served
+        :param current: bool, if True the waiter resolves at once if a last known state satisfies predicate
+        :return: Waiter, whose future resolves to
+                 (component, decoded message, host time the message was received, its decide-rs timestamp)
+        """
+        self.wake()
+        waiter = Waiter(components, predicate, deadline)
+        if current:
+            for comp in components:
+                reading = self.states.get(comp)
+                if (reading is not None) and predicate(reading.parsed()):
+                    waiter.future.set_result((comp, reading.state, reading.received, reading.time))
+                    return waiter
+        for comp in components:
+            self.waiters.setdefault(comp, []).append(waiter)
+        return waiter
+
+    def unwatch(self, waiter):
+        for comp in waiter.components:
+            waiters = self.waiters.get(comp, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+
+    async def command(self, request_type: str, component: str, body=None, timeout=TIMEOUT, retries=None,
+                      wait=True):
+        """
+        Send a request to decide-rs and await its reply.
+        An unanswered request gets the command socket recycled, as whatever decide-rs was doing with it is lost,
+        unless other requests are still awaiting their replies on it.
+        Idempotent requests are then resent with exponential backoff, others fail at once.
+        :param request_type: str, name of a RequestType
+        :param component: str, name of decide-core component
+        :param body: dict, fields of the component's state or params
+        :param timeout: time(ms) to await each reply, negative to wait indefinitely
+        :param retries: optional, resends after the first attempt.
+                        Defaults to REQUEST_RETRIES for idempotent requests (see IDEMPOTENT), 0 for others
+        :param wait: bool, if True hold the request while decide-rs is being reconnected to
+        :return: decoded state or params if the reply holds one, None otherwise or if an attempt went unanswered.
+                 Raises ConnectionError once retries of an idempotent request are exhausted
+        """
+        message = Request.cached(request_type, component, body).frames
+        if retries is None:
+            retries = REQUEST_RETRIES if request_type in IDEMPOTENT else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+                logger.warning(f"{request_type} - {component} Resending, attempt {attempt + 1} of {retries + 1}")
+            if wait:
+                await self.ready.wait()
+            answer = await self._call(request_type, component, message, timeout)
+            if answer is not None:
+                break
+        else:
+            if retries:
+                rep_err(f"No reply from decide-rs to {request_type} after {retries + 1} attempts",
+                        component, ConnectionError)
+            return
+        dc, reply = answer
+        logger.dispatch(f" {request_type} - {component}  Reply received '{reply}'")
+        if dc[0] != DECIDE_VERSION:
+            logger.warning(f"Mismatch Version of DECIDE-RS in reply {dc[0]}")
+
+        # Parse Reply:
+        rep_template = dc_db.Reply()
+        rep_template.ParseFromString(reply)
+        result = rep_template.WhichOneof('result')
+        logger.dispatch(f" {request_type} - {component}  Reply parsed as {result}")
+        if result == 'ok':
+            if request_type == "SetParameters":
+                self.parameters[component] = (dict(body or {}), timeout)
+            return
+        elif result == 'error':
+            logger.error(f"Reply error from decide-rs: {rep_template.error}")
+        elif result == 'params':  # decode params
+            any_params = rep_template.params
+            params = parser('param', component).from_any(any_params)
+            decoded = decode(params)
+            logger.dispatch(f" Response {request_type} - {component} params parsed")
+            return decoded
+        elif result == 'state':
+            any_state = rep_template.state
+            state = parser('state', component).from_any(any_state)
+            decoded = decode(state)
+            if state is not None:
+                last = self.states.get(component)
+                self.states[component] = Reading(component, last.seq if last else 0, time.time(),
+                                                   message=state)
+            logger.dispatch(f" {request_type} - {component} Response State parsed")
+            return decoded
+
+    async def _call(self, request_type, component, message, timeout):
+        """
+        One attempt at a request
+        :return: (decide version frames, reply) or None if unanswered
+        """
+        if self.answerer is None or self.answerer.done():
+            self.answerer = asyncio.create_task(self._answer())
+        request_id = (next(self.request_ids) % 2**32).to_bytes(4, 'little')
+        waiter = asyncio.get_running_loop().create_future()
+        # registered before sending, as the send may suspend this task until after the reply came in
+        self.pending[request_id] = waiter
+        sent = time.time()
+        try:
+            await self.caller.send_multipart([request_id, b"", *message])
+        except BaseException:  # cancelled or failed, nothing will come of it
+            self.pending.pop(request_id, None)
+            raise
         logger.dispatch(f"Request {request_type} - {component} sent, awaiting response")
-        poll_res = await self.caller.poll(timeout=timeout)
-        logger.dispatch(f"Response {request_type} - {component} received")
-        if poll_res == zmq.POLLIN:
-            *dc, reply = await self.caller.recv_multipart()
-            logger.dispatch(f" {request_type} - {component}  Reply received '{reply}'")
-            if dc[0] != DECIDE_VERSION:
-                logger.warning(f"Mismatch Version of DECIDE-RS in reply {dc[0]}")
-
-            # Parse Reply:
-            rep_template = dc_db.Reply()
-            rep_template.ParseFromString(reply)
-            result = rep_template.WhichOneof('result')
-            logger.dispatch(f" {request_type} - {component}  Reply parsed as {result}")
-            if result == 'ok':
-                return
-            elif result == 'error':
-                logger.error(f"Reply error from decide-rs: {rep_template.error}")
-            elif result == 'params':  # decode params
-                any_params = rep_template.params
-                part = Component('param', component)
-                params = await part.from_any(any_params)
-                decoded = MessageToDict(params,
-                                        including_default_value_fields=True,
-                                        preserving_proto_field_name=True)
-                logger.dispatch(f" Response {request_type} - {component} params parsed")
-                return decoded
-            elif result == 'state':
-                any_state = rep_template.state
-                part = Component('state', component)
-                state = await part.from_any(any_state)
-                decoded = MessageToDict(state,
-                                        including_default_value_fields=True,
-                                        preserving_proto_field_name=True)
-                logger.dispatch(f" {request_type} - {component} Response State parsed")
-                return decoded
-        else:  # timeout awaiting response
+        try:
+            dc, reply, answered = await asyncio.wait_for(waiter,
+                                                         timeout=timeout / 1000 if timeout >= 0 else None)
+        except asyncio.TimeoutError:
+            latency.miss(component, request_type, 'reply', rig=self.rig.name)
             logger.error(f"{request_type} - {component}"
-                         f" Timed out after {TIMEOUT}ms awaiting response from decide-rs")
+                         f" Timed out after {timeout}ms awaiting response from decide-rs")
+            # only this request fails: a late reply to it is discarded, and while others are in flight,
+            # e.g. a slow SetParameters awaited without a timeout, the socket is kept for their replies
+            self.pending.pop(request_id, None)
+            if not self.ready.is_set():
+                pass  # decide-rs is away, and ZMQ is reconnecting the socket already
+            elif self.pending:
+                logger.warning(f"Keeping command socket, {len(self.pending)} other requests in flight")
+            else:
+                self._recycle()
+            return
+        except ConnectionResetError as e:
+            logger.warning(f"{request_type} - {component} Request lost: {e}")
+            return
+        finally:
+            self.pending.pop(request_id, None)
+        latency.record(component, request_type, 'reply', answered - sent, rig=self.rig.name)
+        return dc, reply
+
+    def _recycle(self):
+        """
+        Replace the command socket with a fresh one, discarding whatever decide-rs owes the old one.
+        Requests still awaiting a reply on it are failed with ConnectionResetError.
+        """
+        self.recycled += 1
+        logger.warning(f"Recycling command socket to decide-rs ({self.recycled} so far)")
+        if self.answerer is not None:
+            self.answerer.cancel()
+            self.answerer = None
+        # stop the monitor first, so closing the socket isn't reported as a crash of decide-rs
+        self.caller.disable_monitor()
+        self.caller.close(linger=0)
+        self.caller, self.ping = self._dial('REQ')
+        self._unlink('REQ')
+        self._abandon("command socket recycled")
+
+    def _abandon(self, reason):
+        """
+        Fail every request awaiting a reply with ConnectionResetError, as their replies won't come
+        """
+        for waiter in self.pending.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError(reason))
+        self.pending.clear()
+
+    def _dial(self, kind):
+        """
+        Open a socket to decide-rs, monitored from before it connects so that no connection event is missed.
+        Whenever decide-rs goes away, ZMQ reconnects the socket by itself, trying every RECONNECT_BACKOFF
+        :param kind: 'REQ' for the command socket, 'PUB' for the subscriber
+        :return: socket, its monitor socket
+        """
+        socket = self.context.socket(zmq.DEALER if kind == 'REQ' else zmq.SUB)
+        if kind == 'REQ':
+            # requests wait to be sent until decide-rs is connected, rather than pile up for it while it's away
+            socket.setsockopt(zmq.IMMEDIATE, 1)
+        # attempts are cheap, backing off would only delay resuming by up to the last wait
+        socket.setsockopt(zmq.RECONNECT_IVL, int(RECONNECT_BACKOFF * 1000))
+        monitor = socket.get_monitor_socket()
+        socket.connect(self.rig.req_endpoint if kind == 'REQ' else self.rig.pub_endpoint)
+        return socket, monitor
+
+    async def _answer(self):
+        """
+        Hand every reply on the command channel to the request awaiting it
+        """
+        while True:
+            request_id, _delimiter, *dc, reply = await self.caller.recv_multipart()
+            waiter = self.pending.pop(request_id, None)
+            if waiter is None or waiter.done():
+                logger.warning(f"Discarding reply to request {int.from_bytes(request_id, 'little')},"
+                               f" no longer awaited")
+                continue
+            # stamped on receipt, the awaiting request may only resume after other tasks had their turn
+            waiter.set_result((dc, reply, time.time()))
 
     async def eye(self):
         logger.dispatch("The Eye is watching")
+        self.wake()
         try:
-            await asyncio.gather(self._catch(), self._bee_gee())
+            await asyncio.gather(self.reader, self.seer, self._catch(), self._upload(), self._bee_gee())
         except asyncio.CancelledError:
             logger.warning("Decide-Core Pub Watcher has been cancelled due to another task's failure.")
 
+    async def _read(self):
+        """
+        Receive PUB frames and hand them to the consumers. Awaiting the asyncio socket costs a future per
+        message, so once one arrives, whatever else is queued is taken straight from the same socket,
+        READ_BATCH messages at most before the consumers get their turn.
+        """
+        drain = None
+        while True:
+            subscriber = self.subscriber
+            *topic, msg = await subscriber.recv_multipart()
+            if (drain is None) or (drain.underlying != subscriber.underlying):
+                drain = zmq.Socket.shadow(subscriber.underlying)
+            for taken in range(1, READ_BATCH + 1):
+                received = time.time()
+                if self.capture is not None:
+                    self.capture.write(topic[0], msg, received)
+                self.take(topic[0], msg, received)
+                if taken == READ_BATCH:
+                    await asyncio.sleep(0)
+                    break
+                try:
+                    *topic, msg = drain.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+
+    def take(self, topic, msg, received):
+        """
+        Hand a PUB frame to every consumer
+        :param topic: bytes, PUB topic, e.g. b'state/peck-keys'
+        :param msg: bytes, serialized Pub message
+        :param received: host time (s) the frame was received
+        """
+        route = read_topic(topic)
+        if route is None:
+            # error and log messages, or states of an unregistered component, have no parser to take them
+            if topic not in self.unhandled:
+                self.unhandled.add(topic)
+                logger.warning(f"Skipping PUB messages on {topic.decode('utf-8', 'replace')}, no parser for them")
+            return
+        state, comp = route
+        logger.dispatch(f"Reader received PUB event from {comp}")
+        item = (state, comp, msg, received)
+        last = self.states.get(comp)
+        self.states[comp] = Reading(comp, last.seq + 1 if last else 1, received, pub=msg)
+        self.collected.offer(item)
+        self.scried.offer(item)
+        if comp == 'house-light':
+            self.lit.offer(item)
+
+    async def _divine(self):
+        """
+        Scry dispatcher: each message is parsed once and delivered to every waiter it satisfies.
+        Messages no waiter is interested in are dropped rather than left for a later scry.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            state, comp, msg, received = await self.scried.get()
+            waiters = self.waiters.get(comp)
+            if not waiters:
+                continue
+            tstamp, state_msg = parser(state, comp).from_pub(msg)
+            now = loop.time()
+            decoded = None
+            for waiter in list(waiters):
+                if waiter.future.done() or ((waiter.deadline is not None) and (now > waiter.deadline)):
+                    continue
+                try:
+                    matched = waiter.predicate(state_msg)
+                except Exception as e:  # the waiter's own condition failed, not the dispatcher
+                    waiter.future.set_exception(e)
+                    continue
+                if matched:
+                    if decoded is None:
+                        decoded = decode(state_msg)
+                        published = tstamp.ToMicroseconds() / 1e6
+                    waiter.future.set_result((comp, decoded.copy(), received, published))
+            if decoded is not None:
+                # let resolved scrys run on, so a follow-up wait is registered before the next message
+                await asyncio.sleep(0)
+
     async def _catch(self):
         while True:
-            *topic, msg = await self.collector.recv_multipart()
-            state, comp = topic[0].decode("utf-8").split("/")
+            state, comp, msg, received = await self.collected.get()
             logger.dispatch(f"Monitor caught emitted PUB event from {comp}")
-            proto_comp = Component(state, comp)
-            tstamp, state_msg = await proto_comp.from_pub(msg)
-            await asyncio.sleep(0.01)
-            decoded = MessageToDict(state_msg,
-                                    including_default_value_fields=True,
-                                    preserving_proto_field_name=True)
-            # log event here
+            tstamp, state_msg = parser(state, comp).from_pub(msg)
+            self.clock.update(tstamp.ToMicroseconds() / 1e6, received)
+            decoded = decode(state_msg)
+            # log event here, stamped with its receipt rather than whenever the upload gets to it
             msg = {
                 'name': comp,
-                'state': decoded.copy()
+                'state': decoded.copy(),
+                'time': received
             }
             logger.dispatch(f"Monitor decoded message from {comp}: {decoded}")
-            await post_host(msg, target='events')
+            await self.uploads.push(msg)
+
+    def _spill(self, item):
+        """
+        Write a PUB frame the collector has no room for to the dropped events file, decoded as _catch() would
+        """
+        state, comp, msg, received = item
+        _tstamp, state_msg = parser(state, comp).from_pub(msg)
+        msg = {'name': comp, 'state': decode(state_msg), 'time': received}
+        log_dropped('events', stamp(msg, self.rig.identity))
+
+    async def _upload(self):
+        await self.courier.deliver(self.uploads)
 
     async def _bee_gee(self):
-        from zmq.utils.monitor import recv_monitor_message
-        events = {}
-        for name in dir(zmq):
-            if name.startswith('EVENT_'):
-                value = getattr(zmq, name)
-                events[value] = name
+        """
+        Follow the connection events of both sockets to decide-rs as they happen
+        """
+        await asyncio.gather(self._heed('REQ'), self._heed('PUB'))
+
+    async def _heed(self, kind):
+        """
+        Keep track of one socket's connection, reconnecting once it's lost
+        :param kind: 'REQ' for the command socket, 'PUB' for the subscriber
+        """
         while True:
-            for i, heart in enumerate([self.ping, self.pong]):
-                heartbeat = heart.poll(timeout=0.1)
-                if heartbeat != 0:
-                    evt = {}
-                    mon_evt = await recv_monitor_message(heart)
-                    evt.update(mon_evt)
-                    evt['description'] = events[evt['event']]
-                    logger.warning(f"Event from {'REQ' if i else 'PUB'} monitor socket: {evt['description']}")
-                    if evt['event'] in [zmq.EVENT_DISCONNECTED, zmq.EVENT_CLOSED]:
-                        raise RuntimeError(f"Event {evt['description']} on decide-core zmq sockets. Check for crash.")
-            await asyncio.sleep(5)
+            heart = self._heart(kind)
+            try:
+                event = await recv_monitor_message(heart)
+            except asyncio.CancelledError:
+                if heart.closed:
+                    continue
+                raise
+            if heart is not self._heart(kind):  # monitor of a replaced socket
+                heart.close(linger=0)
+                continue
+            description = EVENTS.get(event['event'], event['event'])
+            if event['event'] == zmq.EVENT_CONNECTED:
+                logger.info(f"{kind} socket connected to decide-rs")
+                self.links[kind] = True
+                if all(self.links.values()):
+                    self.linked.set()
+            elif event['event'] in [zmq.EVENT_DISCONNECTED, zmq.EVENT_CLOSED]:
+                self._unlink(kind)
+                if self.ready.is_set():
+                    logger.warning(f"Event from {kind} monitor socket: {description}")
+                    # paused right away, the other socket's disconnect may be handled before the task starts
+                    self.ready.clear()
+                    self.reconnecting = asyncio.create_task(self._reconnect())
+                else:  # failed attempts while reconnecting
+                    logger.dispatch(f"Event from {kind} monitor socket: {description}")
+            else:
+                logger.dispatch(f"Event from {kind} monitor socket: {description}")
+
+    def _heart(self, kind):
+        return self.ping if kind == 'REQ' else self.pong
+
+    def _unlink(self, kind):
+        self.links[kind] = False
+        self.linked.clear()
+
+    async def _reconnect(self):
+        """
+        Hold requests and scrys while decide-rs is away. ZMQ reconnects both sockets by itself, and once they
+        are connected the state of every component heard from is resynced, and the parameters set on them
+        restored, before resuming. Connection events are awaited, and resyncs tried, backing off from
+        RECONNECT_BACKOFF up to RECONNECT_MAX.
+        """
+        loop = asyncio.get_running_loop()
+        self.outages += 1
+        began = loop.time()
+        logger.error(f"Lost connection to decide-rs, pausing until it is back. {self.outages} outages so far")
+        # replies owed from before the outage won't come, requests that can be are resent once it is over
+        self._abandon("connection to decide-rs lost")
+        delay = RECONNECT_BACKOFF
+        while True:
+            try:
+                await asyncio.wait_for(self.linked.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                states = await asyncio.wait_for(self.resync(retries=0, wait=False), delay + TIMEOUT / 1000)
+            except asyncio.TimeoutError:
+                states = [None]
+            # the resync only shows that requests are answered, the subscriber must be connected too
+            if self.linked.is_set() and (None not in states) and await self._restore():
+                break
+            delay = min(delay * 2, RECONNECT_MAX)
+            logger.warning(f"decide-rs still unreachable, retrying in {delay}s")
+        outage = loop.time() - began
+        self.downtime.record(outage)
+        logger.warning(f"Reconnected to decide-rs after {outage:.2f}s, resuming")
+        self.ready.set()
+
+    async def _restore(self):
+        """
+        Set the parameters last set on each component again, as a restarted decide-rs is back to its defaults,
+        e.g. no stepper-motor timeout and no stimuli config
+        :return: bool, True once every component has its parameters back
+        """
+        if not self.parameters:
+            return True
+        logger.warning(f"Restoring parameters of {list(self.parameters)}")
+        try:
+            # one at a time, a slow one such as loading the stimuli config would time out those behind it
+            for comp, (body, timeout) in list(self.parameters.items()):
+                await self.command(request_type="SetParameters", component=comp, body=body, timeout=timeout,
+                                   wait=False)
+        except ConnectionError as e:
+            logger.error(f"Unable to restore parameters of decide-rs components: {e}")
+            return False
+        return True
+
+
+class Waiter:
+    __slots__ = ('components', 'predicate', 'deadline', 'future')
+
+    def __init__(self, components, predicate, deadline=None):
+        self.components = components
+        self.predicate = predicate
+        self.deadline = deadline
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class Clock:
+    """
+    Estimate of the offset between decide-rs' clock and the host's, such that
+    host time = decide-rs time + offset. Taken as the smallest receipt delay over a sliding window
+    of PUB messages, i.e. the message that spent the least time in transit and in the queues.
+    """
+    def __init__(self, window=512):
+        self.window = window
+        self.count = 0
+        # (sample number, delay) in increasing order of delay, the window minimum is at the left
+        self.minima = collections.deque()
+        self.offset = None
+
+    def update(self, published, received):
+        delay = received - published
+        while self.minima and self.minima[-1][1] >= delay:
+            self.minima.pop()
+        self.minima.append((self.count, delay))
+        if self.minima[0][0] <= self.count - self.window:
+            self.minima.popleft()
+        self.count += 1
+        self.offset = self.minima[0][1]
+
+    def to_hardware(self, host_time):
+        """
+        :return: decide-rs time corresponding to a host time, None until an offset has been estimated
+        """
+        if self.offset is None:
+            return None
+        return host_time - self.offset
+
+
+class Reading:
+    """
+    Last known state of a component, from its latest PUB message or a GetState reply.
+    seq counts the PUB messages received from the component, received is the host time (s) it was heard.
+    Decoded when first read.
+    """
+    __slots__ = ('component', 'seq', 'received', 'pub', 'message', '_state', '_time')
+
+    def __init__(self, component, seq, received, pub=None, message=None):
+        self.component = component
+        self.seq = seq
+        self.received = received
+        self.pub = pub
+        self.message = None
+        if message is not None:
+            self.message = message.__class__()
+            self.message.CopyFrom(message)
+        self._state = None
+        self._time = None
+
+    def parsed(self):
+        """
+        :return: the parsed protobuf state message, valid until the component's parser is next used
+        """
+        if self.message is not None:
+            return self.message
+        tstamp, message = parser('state', self.component).from_pub(self.pub)
+        if self._time is None:
+            self._time = tstamp.ToMicroseconds() / 1e6
+        return message
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = decode(self.parsed())
+        return self._state.copy()
+
+    @property
+    def time(self):
+        """
+        decide-rs timestamp (s) of the PUB message, None for a reading from a GetState reply
+        """
+        if (self._time is None) and (self.pub is not None):
+            self.parsed()
+        return self._time
 
 
 class Request:
+    """
+    A request serialized into its multipart frames, minus the envelope. Requests are sent as often as
+    an LED is switched or a stimulus stopped, so each distinct one is serialized once and kept in
+    `commands`, see cached(). Instances are shared and must not be modified.
+    """
+    __slots__ = ('request_type', 'component', 'type_encode', 'body', 'frames')
+
     @classmethod
     async def spawn(cls, request_type: str, component: str, body=None):
+        return cls.encode(request_type, component, body)
+
+    @classmethod
+    def encode(cls, request_type: str, component: str, body=None):
         self = Request()
         logger.dispatch(f"{request_type} - {component} Initiating Request.")
         if request_type in ["SetParameters", "GetParameters"]:
             body_encode = Component('param', component, data=body)
-            request = await body_encode.to_req()
+            request = dc_db.ComponentParams()
+            request.parameters.Pack(body_encode.data)
         elif request_type in ["ChangeState", "GetState"]:
             body_encode = Component('state', component, data=body)
-            request = await body_encode.to_req()
+            request = dc_db.StateChange()
+            request.state.Pack(body_encode.data)
         else:
             logger.error(f"Unsupported Request Type {request_type} for {component}")
-            raise
+            raise ValueError(f"Unsupported Request Type {request_type} for {component}")
         self.request_type = request_type
         self.type_encode = RequestType[request_type].value.to_bytes(2, 'little')
         self.component = component
         self.body = request.SerializeToString()
+        self.frames = (DECIDE_VERSION, self.type_encode, self.body, component.encode('utf-8'))
         logger.dispatch(f"{request_type} - {component} Req Serialized to String")
         return self
 
+    @classmethod
+    def cached(cls, request_type: str, component: str, body=None):
+        """
+        The request, serialized on its first use only. The least recently used requests are
+        forgotten beyond COMMAND_CACHE of them; bodies with unhashable values are never kept.
+        """
+        try:
+            key = (request_type, component, tuple(sorted(body.items())) if body else ())
+            request = commands.pop(key, None)
+        except TypeError:
+            return cls.encode(request_type, component, body)
+        if request is None:
+            cache['misses'] += 1
+            request = cls.encode(request_type, component, body)
+            if len(commands) >= COMMAND_CACHE:
+                commands.popitem(last=False)
+        else:
+            cache['hits'] += 1
+        commands[key] = request
+        return request
+
+
+# (request type, component, sorted body items) -> Request, in order of last use
+commands = collections.OrderedDict()
+cache = {'hits': 0, 'misses': 0}
+metrics.register('command_cache', lambda: dict(cache, size=len(commands)))
+
 
 class RequestType(Enum):
     ChangeState = 0x00
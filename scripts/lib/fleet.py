@@ -0,0 +1,217 @@
+import os
+import sys
+import asyncio
+import logging
+import importlib.util
+import multiprocessing
+from .config import *
+from . import metrics
+from . import rig as rigs
+from .rig import Rig
+from .report import set_server
+from .vigil import run
+
+logger = logging.getLogger('main')
+
+SCRIPTS = ['lights', 'shape', 'interrupt_shape', 'gng', 'interrupt_gng']
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summon(entry):
+    """
+    Load a fresh copy of a box's script, so that its globals are apart from every other box's
+    :param entry: dict, the box's entry in the rigs file
+    :return: Rig of the box, loaded script module
+    """
+    rig = Rig(name=entry['name'],
+              identity=entry.get('identity', entry['name']),
+              req_endpoint=entry['req_endpoint'],
+              pub_endpoint=entry['pub_endpoint'],
+              port_ctrl=entry['port_ctrl'])
+    script = entry['script']
+    if script not in SCRIPTS:
+        raise ValueError(f"Unknown script {script} for {rig.name}, expected one of {SCRIPTS}")
+    spec = importlib.util.spec_from_file_location(f"{script}_{rig.name}", os.path.join(HERE, f"{script}.py"))
+    module = importlib.util.module_from_spec(spec)
+    # the script parses its arguments and sets up its log file as it loads
+    argv = sys.argv
+    token = rigs.enter(rig)
+    try:
+        sys.argv = [f"{script}.py", *[str(arg) for arg in entry.get('args', [])]]
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+        rigs.leave(token)
+    return rig, module
+
+
+async def tend(rig, module):
+    """
+    Run a box's script. A box that fails is logged and left stopped, without disturbing the others
+    """
+    try:
+        await module.main()
+    except SystemExit as e:
+        logger.error(f"{rig.name} stopped: {e}")
+    except Exception as e:
+        logger.error(f"{rig.name} failed: {e}")
+
+
+def herd(entries, saved=None):
+    """
+    Load and start the boxes of entries in the running event loop
+    :param entries: list of rigs file entries
+    :param saved: optional, dict of rig name to experiment state to resume from
+    :return: dict of rig name to (Rig, script module, task)
+    """
+    saved = saved or {}
+    boxes = {}
+    for entry in entries:
+        try:
+            rig, module = summon(entry)
+        except (Exception, SystemExit) as e:  # argparse exits on bad arguments
+            logger.error(f"Unable to load box {entry.get('name')}: {e}")
+            continue
+        if (rig.name in saved) and isinstance(getattr(module, 'state', None), dict):
+            module.state.update(saved[rig.name])
+            logger.info(f"{rig.name} resuming from {saved[rig.name]}")
+        # the box's tasks, and every task they start, run as that rig
+        token = rigs.enter(rig)
+        boxes[rig.name] = (rig, module, asyncio.create_task(tend(rig, module)))
+        rigs.leave(token)
+    logger.info(f"Supervising {len(boxes)} boxes")
+    return boxes
+
+
+def survey(boxes):
+    """
+    :return: dict of rig name to the box's experiment state, params and metrics
+    """
+    return {name: {
+        'running': not task.done(),
+        'state': getattr(module, 'state', None),
+        'params': getattr(module, 'params', None),
+        'metrics': metrics.snapshot(name),
+    } for name, (rig, module, task) in boxes.items()}
+
+
+def work(index, entries, saved, conn):
+    """
+    Worker process running a shard of the boxes, reporting on them to the parent through conn
+    """
+    try:
+        run(_work(index, entries, saved, conn))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _work(index, entries, saved, conn):
+    boxes = herd(entries, saved)
+    while True:
+        conn.send({'pid': os.getpid(), 'boxes': survey(boxes), 'metrics': metrics.snapshot()})
+        await asyncio.sleep(REPORT_INTERVAL)
+
+
+class Shepherd:
+    """
+    Shards boxes across worker processes, one event loop each. The parent health-checks the workers
+    by their periodic reports, restarts any that died or went silent with their boxes' last reported
+    state, and serves a report covering every box as the host's single report server.
+    """
+    def __init__(self, entries, workers, interval=REPORT_INTERVAL, grace=WORKER_GRACE):
+        """
+        :param entries: list of rigs file entries
+        :param workers: int, number of worker processes
+        :param interval: seconds between health checks
+        :param grace: seconds a worker may go without reporting before it is restarted
+        """
+        self.shards = [entries[i::workers] for i in range(workers)]
+        self.interval = interval
+        self.grace = grace
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = [None] * workers
+        self.conns = [None] * workers
+        self.heard = [0.0] * workers
+        self.reports = [{} for _ in range(workers)]
+        self.restarts = [0] * workers
+        # last reported experiment state of every box, handed to its worker on restart
+        self.saved = {}
+        metrics.register('workers', self.health)
+
+    def start(self, index):
+        loop = asyncio.get_running_loop()
+        saved = {entry['name']: self.saved[entry['name']] for entry in self.shards[index]
+                 if entry['name'] in self.saved}
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=work, args=(index, self.shards[index], saved, sender),
+                                       name=f"worker-{index}", daemon=True)
+        process.start()
+        sender.close()
+        self.processes[index] = process
+        self.conns[index] = receiver
+        self.heard[index] = loop.time()
+        loop.add_reader(receiver.fileno(), self._receive, index)
+        logger.info(f"Worker {index} started with boxes {[entry['name'] for entry in self.shards[index]]}")
+
+    def stop(self, index):
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.conns[index].fileno())
+        self.conns[index].close()
+        process = self.processes[index]
+        if process.is_alive():
+            process.kill()
+        process.join()
+
+    def _receive(self, index):
+        try:
+            report = self.conns[index].recv()
+        except (EOFError, OSError):  # worker gone, the health check restarts it
+            asyncio.get_running_loop().remove_reader(self.conns[index].fileno())
+            return
+        self.heard[index] = asyncio.get_running_loop().time()
+        self.reports[index] = report
+        for name, box in report['boxes'].items():
+            if isinstance(box['state'], dict):
+                self.saved[name] = box['state']
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            for index, process in enumerate(self.processes):
+                silent = loop.time() - self.heard[index]
+                if process.is_alive() and (silent < self.grace):
+                    continue
+                if process.is_alive():
+                    logger.error(f"Worker {index} silent for {silent:.0f}s, restarting")
+                else:
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                self.stop(index)
+                self.restarts[index] += 1
+                self.start(index)
+
+    def health(self):
+        loop = asyncio.get_running_loop()
+        return {str(index): {
+            'pid': process.pid,
+            'alive': process.is_alive(),
+            'silent': loop.time() - self.heard[index],
+            'restarts': self.restarts[index],
+            'boxes': [entry['name'] for entry in self.shards[index]],
+            'metrics': self.reports[index].get('metrics'),
+        } for index, process in enumerate(self.processes)}
+
+    def report(self, info=None):
+        """
+        Report server response covering the boxes of every worker
+        """
+        boxes = {}
+        for index, report in enumerate(self.reports):
+            for name, box in report.get('boxes', {}).items():
+                boxes[name] = dict(box, worker=index)
+        return {'script': 'supervisor', 'device': rigs.current().identity, 'boxes': boxes, 'metrics': metrics.snapshot()}
+
+    async def run(self):
+        for index in range(len(self.shards)):
+            self.start(index)
+        await asyncio.gather(self.watch(), set_server(snd_resp=self.report))
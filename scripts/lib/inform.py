@@ -1,17 +1,27 @@
 import logging
+import asyncio
 import aiohttp
 import requests
 import time
 import os
 import json
+import hashlib
+import collections
 from .config import *
+from .spool import Spool
+from . import metrics
+from . import rig as rigs
 logger = logging.getLogger('main')
 
+# One HTTP session, and so one connection pool, for every rig in the process
+session = None
+
 
 async def contact_host():
     global session
     if CONTACT_HOST:
-        session = aiohttp.ClientSession()
+        if (session is None) or session.closed:
+            session = aiohttp.ClientSession()
         try:
             async with session.get(url=f"{HIVEMIND}/info/") as result:
                 logger.dispatch("Response received from Decide-Host")
@@ -33,7 +43,7 @@ async def contact_host():
 async def post_host(msg: dict, target):
     """
     Send a POST request to the decide API specified in py_crust's config
-    :param msg: dictionary of data. address and time will be automatically filled out
+    :param msg: dictionary of data. address and time will be automatically filled out, unless already stamped
     :param target: 'trials' or 'events'
     :return:
     """
@@ -42,10 +52,7 @@ async def post_host(msg: dict, target):
         logger.error(f"Specified type for decide API logging incorrect: {target}")
         raise
     if CONTACT_HOST:
-        msg.update({
-            'addr': IDENTITY,
-            'time': time.time()
-        })
+        stamp(msg)
         try:
             async with session.post(url=f"{HIVEMIND}/{target}/",
                                     json=msg,
@@ -56,46 +63,280 @@ async def post_host(msg: dict, target):
                     logger.error(f'Error {result.status} from submitting data to Decide-Host')
                 else:
                     logger.dispatch("Data logged to DecideAPI.")
-                    await post_dropped(target)
+                    post_dropped(target)
         except aiohttp.ClientConnectionError as e:
             logger.error('Could not contact Decide-Host:', str(e))
             log_dropped(target, msg)
 
 
-def log_dropped(target, msg):
-    try:
-        with open(f'/root/py_crust/dropped_{target}.json', 'r+') as file:
-            current_dropped = json.load(file)
-    except FileNotFoundError as e:  # empty file
-        logger.debug(f"Dropped_{target} JSON Storage Does not exist yet. Creating file.")
-        current_dropped = []
-    current_dropped.append(msg)
-    with open(f'/root/py_crust/dropped_{target}.json', 'w+') as file:
-        json.dump(current_dropped, file, indent=4, separators=(',', ': '))
+def stamp(msg: dict, identity=None):
+    """
+    Fill out the address and the time of a record for Decide-Host, unless it already carries them
+    :param identity: optional, address to stamp, defaults to the current rig's
+    """
+    msg.setdefault('addr', identity or rigs.current().identity)
+    msg.setdefault('time', time.time())
+    return msg
 
 
-async def post_dropped(target):
-    try:
-        with open(f'/root/py_crust/dropped_{target}.json', 'r') as file:
-            data = json.load(file)
-            for d in data:
+class Courier:
+    """
+    Posts records for one target to Decide-Host in batches. A batch is sent once it holds
+    `size` records or once the first record in it has waited `deadline` seconds.
+    Hosts without a bulk endpoint get the same records as single-record posts.
+    """
+    def __init__(self, target, size=BATCH_SIZE, deadline=BATCH_DEADLINE, identity=None):
+        if target not in ['trials', 'events']:
+            logger.error(f"Specified type for decide API logging incorrect: {target}")
+            raise ValueError(f"Unknown Decide-Host target {target}")
+        self.target = target
+        self.size = size
+        self.deadline = deadline
+        self.identity = identity
+        self.bulk = True
+
+    async def deliver(self, queue: asyncio.Queue):
+        """
+        Drain a queue of records forever, posting them in batches
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            expiry = loop.time() + self.deadline
+            while len(batch) < self.size:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                remaining = expiry - loop.time()
+                if remaining <= 0:
+                    break
                 try:
-                    async with session.post(url=f"{HIVEMIND}/{target}/",
-                                            json=d,
-                                            headers={'Content-Type': 'application/json'}
-                                            ) as result:
-                        if result.status == 400:
-                            continue # data already logged or conflicted
-                        elif not result.ok:
-                            logger.error(f'Error {result.status} from submitting data to Decide-Host:')
-                            return
-                        else:
-                            logger.dispatch("Data logged to DecideAPI.")
-                except aiohttp.ClientConnectionError as e:
-                    logger.error('Could not contact Decide-Host:', str(e))
-        os.remove(f'/root/py_crust/dropped_{target}.json')
-    except FileNotFoundError:
-        return
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self.post(batch)
+
+    async def post(self, batch: list):
+        """
+        Send a batch of records with a single request, falling back to single-record posts
+        if the host has no bulk endpoint. Records the host reports as failed are dropped for replay.
+        :param batch: list of record dicts. address and time will be filled out, unless already stamped
+        """
+        if not CONTACT_HOST:
+            return
+        for msg in batch:
+            stamp(msg, self.identity)
+        if not self.bulk:
+            for msg in batch:
+                await post_host(msg, target=self.target)
+            return
+        try:
+            async with session.post(url=f"{HIVEMIND}/{self.target}/batch/",
+                                    json=batch,
+                                    headers={'Content-Type': 'application/json'}
+                                    ) as result:
+                if result.status in (404, 405):
+                    logger.warning(f"Decide-Host has no bulk endpoint for {self.target},"
+                                   f" posting records individually")
+                    self.bulk = False
+                    for msg in batch:
+                        await post_host(msg, target=self.target)
+                    return
+                elif not result.ok:
+                    logger.error(f'Error {result.status} from submitting batch of {len(batch)} to Decide-Host')
+                    for msg in batch:
+                        log_dropped(self.target, msg)
+                    return
+                # the host may accept a batch in part, listing the indices it did not log
+                try:
+                    reply = await result.json(content_type=None)
+                except ValueError:
+                    reply = None
+                failed = reply.get('failed', []) if isinstance(reply, dict) else []
+                if not (isinstance(failed, list)
+                        and all(isinstance(i, int) and not isinstance(i, bool) and 0 <= i < len(batch)
+                                for i in failed)):
+                    # no telling which records were logged, so all of them are replayed
+                    logger.error(f"Malformed reply from Decide-Host to batch of {len(batch)}: {reply}")
+                    for msg in batch:
+                        log_dropped(self.target, msg)
+                    return
+                failed = sorted(set(failed))
+                for i in failed:
+                    log_dropped(self.target, batch[i])
+                if failed:
+                    logger.error(f"Decide-Host failed to log {len(failed)} of {len(batch)} records")
+                    return
+                logger.dispatch(f"Batch of {len(batch)} logged to DecideAPI.")
+        except aiohttp.ClientConnectionError as e:
+            logger.error(f'Could not contact Decide-Host: {e}')
+            for msg in batch:
+                log_dropped(self.target, msg)
+            return
+        post_dropped(self.target)
+
+
+spools = {}
+
+
+def spool(target):
+    """
+    Spool of dropped records for a target, opened on first use.
+    Records left in a legacy dropped_{target}.json are moved into it.
+    """
+    if target not in spools:
+        spools[target] = Spool(f'/root/py_crust/dropped_{target}.jsonl',
+                               sync_every=SPOOL_SYNC,
+                               compact_at=SPOOL_COMPACT)
+        legacy = f'/root/py_crust/dropped_{target}.json'
+        if os.path.exists(legacy):
+            with open(legacy, 'r') as file:
+                for msg in json.load(file):
+                    spools[target].append(msg)
+            spools[target].sync()
+            os.remove(legacy)
+            logger.info(f"Moved legacy {legacy} into dropped {target} spool")
+    return spools[target]
+
+
+def log_dropped(target, msg):
+    spool(target).append(msg)
+
+
+def post_dropped(target):
+    """
+    Have dropped records for a target replayed in the background, now that Decide-Host is reachable
+    """
+    if target not in replayers:
+        replayers[target] = Replayer(target)
+        metrics.register(f"replay-{target}", replayers[target].stats)
+    replayers[target].wake()
+
+
+def idempotency_key(msg):
+    """
+    Key identifying a record to Decide-Host, the same every time the record is replayed
+    """
+    return hashlib.sha1(json.dumps(msg, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+replayers = {}
+
+
+class Replayer:
+    """
+    Background worker posting a target's dropped records back to Decide-Host.
+    Posts run with bounded concurrency and at a capped rate, so replay traffic doesn't crowd out
+    live logging. Each record carries an Idempotency-Key header for the host to dedupe on,
+    as a record whose reply was lost will be sent again. The spool cursor only ever advances
+    past records that were all accepted, and is checkpointed as the replay goes.
+    """
+    def __init__(self, target, concurrency=REPLAY_CONCURRENCY, rate=REPLAY_RATE):
+        self.target = target
+        self.concurrency = concurrency
+        self.rate = rate
+        self.task = None
+        self.wanted = None
+        self.healthy = True
+        self.replayed = 0
+        self.conflicts = 0
+        self.failures = 0
+        self.throughput = 0.0
+
+    def wake(self):
+        if self.task is None or self.task.done():
+            self.wanted = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        self.wanted.set()
+
+    async def run(self):
+        while True:
+            await self.wanted.wait()
+            self.wanted.clear()
+            await self.replay()
+
+    async def replay(self):
+        dropped = spool(self.target)
+        records = dropped.pending()
+        inflight = collections.deque()
+        slots = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        count = 0
+        sent = marked = None
+        self.healthy = True
+        try:
+            for offset, record in records:
+                await slots.acquire()
+                if not self.healthy:  # a failed post ends this replay, the host is struggling
+                    slots.release()
+                    break
+                inflight.append((offset, asyncio.create_task(self._send(record, slots))))
+                count += 1
+                sent = self._settle(inflight, sent)
+                if (sent is not None) and (sent - (marked or 0) > SPOOL_COMPACT):
+                    dropped.checkpoint(sent)
+                    marked = sent
+                if self.rate:
+                    await asyncio.sleep(1 / self.rate)
+            if inflight:
+                await asyncio.wait([task for _, task in inflight])
+            sent = self._settle(inflight, sent)
+        finally:
+            records.close()
+            for _, task in inflight:
+                task.cancel()
+            if sent is not None:
+                dropped.commit(sent)
+            elapsed = loop.time() - start
+            self.throughput = count / elapsed if elapsed > 0 else 0.0
+        if count:
+            logger.info(f"Replayed {count} dropped {self.target} at {self.throughput:.1f}/s")
+
+    def stats(self):
+        return {
+            'backlog_bytes': spool(self.target).backlog(),
+            'replayed': self.replayed,
+            'conflicts': self.conflicts,
+            'failures': self.failures,
+            'throughput': self.throughput,
+        }
+
+    @staticmethod
+    def _settle(inflight, sent):
+        """
+        Advance past the finished posts at the head of the window, up to the first failure
+        """
+        while inflight and inflight[0][1].done():
+            if not inflight[0][1].result():
+                break
+            sent, _ = inflight.popleft()
+        return sent
+
+    async def _send(self, record, slots):
+        try:
+            async with session.post(url=f"{HIVEMIND}/{self.target}/",
+                                    json=record,
+                                    headers={'Content-Type': 'application/json',
+                                             'Idempotency-Key': idempotency_key(record)}
+                                    ) as result:
+                if result.status == 400:
+                    self.conflicts += 1  # data already logged or conflicted
+                elif not result.ok:
+                    logger.error(f'Error {result.status} from replaying data to Decide-Host')
+                    self.failures += 1
+                    self.healthy = False
+                    return False
+                else:
+                    self.replayed += 1
+                return True
+        except aiohttp.ClientConnectionError as e:
+            logger.error(f'Could not contact Decide-Host: {e}')
+            self.failures += 1
+            self.healthy = False
+            return False
+        finally:
+            slots.release()
 
 
 def slack(msg, usr=None):
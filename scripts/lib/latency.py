@@ -0,0 +1,135 @@
+import json
+import math
+import atexit
+import logging
+from pathlib import Path
+
+logger = logging.getLogger('main')
+
+# (rig name, component, request type, stage) -> Histogram. Stages are
+#   reply: request sent to reply received
+#   confirm: request sent to the confirming PUB message received
+histograms = {}
+
+
+class Histogram:
+    """
+    Latency histogram with logarithmic buckets, so that recording is a constant-time increment
+    whatever the number of samples. Quantiles are accurate to the bucket width, 2**(1/per_octave).
+    """
+    def __init__(self, low=1e-4, high=100.0, per_octave=8):
+        """
+        :param low: smallest latency (s) told apart, anything below falls in the first bucket
+        :param high: largest latency (s) told apart, anything above falls in the last bucket
+        :param per_octave: buckets per doubling of latency
+        """
+        self.low = low
+        self.per_octave = per_octave
+        self.counts = [0] * (math.ceil(math.log2(high / low) * per_octave) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.missed = 0
+
+    def record(self, seconds):
+        if seconds <= self.low:
+            index = 0
+        else:
+            index = min(int(math.log2(seconds / self.low) * self.per_octave), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def miss(self):
+        """
+        Count a request that never got its reply or confirmation
+        """
+        self.missed += 1
+
+    def quantile(self, q):
+        """
+        :return: upper bound (s) of the bucket holding the q-th quantile, None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.low * 2 ** ((index + 1) / self.per_octave), self.max)
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'missed': self.missed,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+def histogram(component, request_type, stage, rig=None):
+    key = (rig, component, request_type, stage)
+    found = histograms.get(key)
+    if found is None:
+        found = histograms[key] = Histogram()
+    return found
+
+
+def record(component, request_type, stage, seconds, rig=None):
+    histogram(component, request_type, stage, rig).record(seconds)
+
+
+def miss(component, request_type, stage, rig=None):
+    histogram(component, request_type, stage, rig).miss()
+
+
+def snapshot(rig=None):
+    """
+    :param rig: optional, name of the rig to report on
+    :return: dict of {component: {request type: {stage: stats}}}
+    """
+    report = {}
+    for (owner, component, request_type, stage), found in list(histograms.items()):
+        if owner == rig:
+            report.setdefault(component, {}).setdefault(request_type, {})[stage] = found.stats()
+    return report
+
+
+def dump():
+    """
+    Write every histogram, buckets included, so that runs can be compared offline.
+    Each rig run by the supervisor gets its own file
+    """
+    for rig in {owner for owner, *_ in histograms}:
+        write(rig, "/root/py_crust/log/latency.json" if rig is None else f"/root/py_crust/log/latency_{rig}.json")
+
+
+def write(rig, path):
+    report = snapshot(rig)
+    for (owner, component, request_type, stage), found in histograms.items():
+        if owner != rig:
+            continue
+        report[component][request_type][stage]['buckets'] = {
+            'low': found.low,
+            'per_octave': found.per_octave,
+            'counts': found.counts,
+        }
+    try:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=4)
+        logger.info(f"Command latencies written to {path}")
+    except OSError as e:
+        logger.error(f"Unable to write command latencies to {path}: {e}")
+
+
+atexit.register(dump)
@@ -2,9 +2,34 @@ import logging
 import sys
 from pathlib import Path
 from .config import *
+from .rig import current, supervised
 logger = logging.getLogger('main')
 
+
+class RigTag(logging.Filter):
+    """
+    Label records with the rig they were logged for, optionally keeping only those of one rig
+    """
+    def __init__(self, rig=None):
+        super().__init__()
+        self.rig = rig
+
+    def filter(self, record):
+        if not hasattr(record, 'rig'):
+            record.rig = current().name
+            if record.rig is not None:
+                record.name = f"{record.name}.{record.rig}"
+        return (self.rig is None) or (record.rig == self.rig)
+
+
+logger.addFilter(RigTag())
+
+
 def lincoln(log, level='DEBUG'):
+    """
+    Log to stdout and, if LOCAL_LOG, to a file. Under the supervisor, the stdout handler and level are set up
+    once by the supervisor itself, and each rig's script only adds a file taking that rig's records
+    """
     # Courtesy of https://stackoverflow.com/questions/384076/how-can-i-color-python-logging-output
     class CustomFormatter(logging.Formatter):
 
@@ -36,17 +61,21 @@ def lincoln(log, level='DEBUG'):
             formatter = logging.Formatter(log_fmt)
             return formatter.format(record)
 
-    streamer = logging.StreamHandler(sys.stdout)
-    streamer.setFormatter(CustomFormatter())
-    logger.addHandler(streamer)
+    if not supervised():
+        streamer = logging.StreamHandler(sys.stdout)
+        streamer.setFormatter(CustomFormatter())
+        logger.addHandler(streamer)
     if LOCAL_LOG:
         Path("/root/py_crust/log").mkdir(parents=True, exist_ok=True)
         filer = logging.FileHandler(f"/root/py_crust/log/{log}", mode='w')
         filer.setFormatter(logging.Formatter())
+        if supervised():
+            filer.addFilter(RigTag(current().name))
         logger.addHandler(filer)
 
     logger.info(f"Logging to file {log}. Connecting to DecideAPI")
-    logger.setLevel(level)
+    if not supervised():
+        logger.setLevel(level)
 
 # The following function is taken from https://stackoverflow.com/questions/2183233
 # Checkout module haggis for more information
@@ -0,0 +1,33 @@
+import logging
+
+logger = logging.getLogger('main')
+
+# (rig name, source name) -> function returning a JSON-serializable dict of that source's current metrics
+sources = {}
+
+
+def register(name, source, rig=None):
+    """
+    Make a metrics source visible through snapshot() and the report server.
+    Registering under an existing name replaces the previous source.
+    :param name: str, label the metrics are reported under
+    :param source: fn, takes no arguments, returns a dict
+    :param rig: optional, name of the rig the source belongs to, None for a source shared by every rig
+    """
+    sources[(rig, name)] = source
+
+
+def snapshot(rig=None):
+    """
+    :param rig: optional, name of the rig to report on
+    :return: dict of the current metrics of every shared source and of those registered for rig
+    """
+    report = {}
+    for (owner, name), source in list(sources.items()):
+        if (owner is not None) and (owner != rig):
+            continue
+        try:
+            report[name] = source()
+        except Exception as e:
+            logger.error(f"Metrics source {name} failed: {e}")
+    return report
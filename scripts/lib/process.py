@@ -1,38 +1,67 @@
 import json
 import numpy as np
+from collections import namedtuple
 import zmq.asyncio
 
 from .inform import *
-from .decrypt import Component
+from .decrypt import parser, decode
 from .errata import pub_err, state_err
 from .dispatch import Sauron
-from google.protobuf.json_format import MessageToDict
+from . import latency
+from . import metrics
 import asyncio
 import logging
 
 logger = logging.getLogger('main')
 
 
+# Result of a scry. onset and stamp are decide-rs timestamps (s) of the arming event and the matching
+# message, offset the estimate of host time - decide-rs time when the scry ended,
+# received the host time the matching message was received
+Omen = namedtuple('Omen', ['component', 'interrupted', 'message', 'timer', 'onset', 'stamp', 'offset',
+                           'received'])
+
+
 class Morgoth:
-    def __init__(self, messenger=None):
+    def __init__(self, messenger=None, rig=None):
+        """
+        :param messenger: optional, Sauron to communicate through
+        :param rig: optional, Rig settings of the box if no messenger is given, defaults to the current rig
+        """
         self.messenger = None
         self.sun = None
         self.playback = None
+        # duration (ms) the food motor runs for, set by set_feeder()
+        self.feed_time = 0
         if isinstance(messenger, Sauron):
             self.messenger = messenger
         else:
-            self.messenger = Sauron()
+            self.messenger = Sauron(rig)
+        # component -> changes of state not requested, as decide-rs had already confirmed them
+        self.skipped = {}
+        metrics.register('skipped', lambda: dict(self.skipped), rig=self.messenger.rig.name)
         logger.state("Apparatus initiated.")
 
-    async def scry(self, components, condition, failure=None, timeout=None):
+    async def scry(self, components, condition, failure=None, timeout=None, raw=False, current=False,
+                   since=None):
         """
         Search for incoming messages matching component name and test for specific condition
         Optional failure and timeout.
+        Messages are tested as parsed protobuf messages where possible: only the one that
+        matches is decoded into a dict, unless the condition is a function taking dicts.
+        Held while decide-rs is being reconnected to, see Sauron.ready.
         :param components: str or list, name(s) of decide-core component
-        :param condition: fn, test the dict-type message emmited from core
+        :param condition: dict, {field: value} that all must match in the message emmited from core
+                          or fn, test the dict-type message emmited from core (see raw)
         :param failure: fn, optional error/failure state, only in conjunction with timeout
         :param timeout: time(ms) to await and test messages.
-        :return:
+        :param raw: bool, if True a condition fn is given the parsed protobuf message instead of a dict.
+                    Either way, it sees the messages of every listed component
+        :param current: bool, if True resolve at once when the last known state already satisfies condition
+        :param since: decide-rs timestamp (s) of the event arming this scry, e.g. stimulus onset.
+                      Defaults to the start of the scry, converted to decide-rs time.
+        :return: Omen. Its timer is measured on decide-rs' clock, between the arming event and the
+                 publication of the matching message, whenever both are known.
         """
         interrupted = False
         message = None
@@ -45,52 +74,181 @@ class Morgoth:
         else:
             raise ValueError("Invalid arguments for scry: no component or components specified.")
 
-        async def test(func):
-            nonlocal interrupted, message, start, timer, end, comp
-            while True:
-                *topic, msg = await self.messenger.scryer.recv_multipart()
-                state, comp = topic[0].decode("utf-8").split("/")
-                logger.state(f"Scry {components} - found item in queue from {comp}")
-                if comp not in components:
-                     logger.debug(f"Scry {components} - check failed. Continuing")
-                     continue
-                proto_comp = Component(state, comp)
-                _timestamp, state_msg = await proto_comp.from_pub(msg)
-                decoded = MessageToDict(state_msg,
-                                        including_default_value_fields=True,
-                                        preserving_proto_field_name=True)
-                if func(decoded) is True:
-                    end = time.time()
-                    timer = end - start
-                    message = decoded
-                    interrupted = True
-                    logger.debug(f"Scry {components} - check succeeded. Ending.")
-                    return
-                else:
-                    logger.debug(f"Scry {components} - check failed. Continuing.")
-                    continue
-
-        logger.state(f"Scry process started for {components}, purging queue")
+        await self.messenger.ready.wait()
+        logger.state(f"Scry process started for {components}")
         start = time.time()
+        deadline = None
         if timeout is not None:
             # Sanity check: everything from miliseconds to seconds
             timeout = timeout / 1000 if timeout > 20 else timeout
-            try:
-                await asyncio.wait_for(test(condition), timeout)
-            except asyncio.exceptions.TimeoutError:
-                message = None
-                timer = timeout
-                if failure is not None:
-                    end = time.time()
-                    timer = end - start
-                    logger.error(f"Required response not received within timeout {timeout},"
-                                 f" time elapsed is {timer}")
-                    failure(components)
+            deadline = asyncio.get_running_loop().time() + timeout
+        predicate = augur(condition, raw)
+        waiter = self.messenger.watch(components, predicate, deadline, current)
+        outages = self.messenger.outages
+        stamp = None
+        end = None
+        try:
+            comp, message, end, stamp = await asyncio.wait_for(waiter.future, timeout)
+            interrupted = True
+            logger.debug(f"Scry {components} - check succeeded. Ending.")
+        except asyncio.exceptions.TimeoutError:
+            message = None
+            timer = timeout
+            if (failure is not None) and (self.messenger.outages != outages):
+                # decide-rs was lost meanwhile, the match may only show in the state resynced on reconnect
+                await self.messenger.ready.wait()
+                recheck = self.messenger.watch(components, predicate, current=True)
+                self.messenger.unwatch(recheck)
+                if recheck.future.done():
+                    comp, message, end, stamp = recheck.future.result()
+                    interrupted = True
+            if (failure is not None) and (not interrupted):
+                end = time.time()
+                timer = end - start
+                logger.error(f"Required response not received within timeout {timeout},"
+                             f" time elapsed is {timer}")
+                failure(components)
+        finally:
+            self.messenger.unwatch(waiter)
+
+        clock = self.messenger.clock
+        onset = since if since is not None else clock.to_hardware(start)
+        if interrupted:
+            if (onset is not None) and (stamp is not None):
+                # a match from the last known state may predate the scry
+                timer = max(stamp - onset, 0.0)
+            else:
+                timer = max(end - start, 0.0)
+        logger.state(f"Scry finished for {components}. Unregistering waiter")
+        return Omen(comp, interrupted, message, timer, onset, stamp, clock.offset, end)
+
+    def held(self, component, body):
+        """
+        Check whether decide-rs already confirmed the state a request would set, i.e. the last known state
+        of the component has every field of body. Requests for such a state are skipped and counted.
+        :return: Omen of the last known state if it holds, None otherwise. Its timer is 0 and its stamp the present
+                 on decide-rs' clock (None until the clock offset is known), not that of the earlier confirmation,
+                 so that it serves as the onset of whatever follows the skipped request
+        """
+        reading = self.messenger.last(component)
+        if (reading is None) or (not body) or (not augur(body)(reading.parsed())):
+            return None
+        self.skipped[component] = self.skipped.get(component, 0) + 1
+        logger.state(f"{component} already in {body}, request skipped")
+        clock = self.messenger.clock
+        return Omen(component, True, reading.state, 0.0, None, clock.to_hardware(time.time()), clock.offset,
+                    reading.received)
+
+    async def effect(self, component, body, condition, current=False, timeout=TIMEOUT, force=False):
+        """
+        Request a change of state and await its confirmation on the PUB stream.
+        Times to the reply and to the confirmation are recorded in the latency histograms.
+        :param component: str, name of decide-core component
+        :param body: dict, ChangeState request body
+        :param condition: dict, {field: value} confirming the change, see scry()
+        :param current: bool, see scry()
+        :param timeout: time(ms) to await the confirmation, raises ConnectionError once elapsed
+        :param force: bool, if True send the request even if the state is already in effect, see held()
+        :return: Omen of the confirmation
+        """
+        if not force:
+            confirmed = self.held(component, body)
+            if confirmed is not None:
+                return confirmed
+        sent = time.time()
+        a = asyncio.create_task(self.scry(
+            component,
+            condition=condition,
+            failure=pub_err,
+            current=current,
+            timeout=timeout
+        ))
+        b = asyncio.create_task(self.messenger.command(
+            request_type="ChangeState",
+            component=component,
+            body=body
+        ))
+        try:
+            confirmed, _ = await asyncio.gather(a, b)
+        except ConnectionError:
+            latency.miss(component, "ChangeState", 'confirm', rig=self.messenger.rig.name)
+            raise
+        # a confirmation from the last known state says nothing of decide-rs' latency,
+        # and its stamp predates the request: the change is in effect as of the request instead
+        if confirmed.received >= sent:
+            latency.record(component, "ChangeState", 'confirm', confirmed.received - sent,
+                           rig=self.messenger.rig.name)
         else:
-            await test(condition)
+            confirmed = confirmed._replace(stamp=self.messenger.clock.to_hardware(sent))
+        return confirmed
 
-        logger.state(f"Scry finished for {components}. Unsubscribing from all topics")
-        return comp, interrupted, message, timer
+    async def transact(self, changes, current=False, timeout=TIMEOUT, force=False):
+        """
+        Request changes of state of several components at once, and await all their confirmations on the
+        PUB stream within one deadline: a transition takes about one round trip rather than one per component.
+        Confirmation latencies are recorded as by effect().
+        :param changes: dict of {component: body}, or {component: (body, condition)} when the change is
+                        confirmed by something else than the body's fields, see scry()
+        :param current: bool, see scry()
+        :param timeout: time(ms) to await every confirmation, raises ConnectionError naming those unconfirmed
+        :param force: bool, if True send every request, even for states already in effect, see held()
+        :return: dict of {component: Omen of its confirmation}. Omen timers run from the requests being sent
+                 to the confirmation's publication.
+        """
+        omens = {}
+        if not force:
+            for component, change in changes.items():
+                confirmed = self.held(component, change[0] if isinstance(change, tuple) else change)
+                if confirmed is not None:
+                    omens[component] = confirmed
+            changes = {component: change for component, change in changes.items() if component not in omens}
+        if not changes:
+            return omens
+        await self.messenger.ready.wait()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout / 1000
+        rig = self.messenger.rig.name
+        bodies = {}
+        waiters = {}
+        # every waiter is registered before any request is sent, so that no confirmation goes unseen
+        for component, change in changes.items():
+            body, condition = change if isinstance(change, tuple) else (change, change)
+            bodies[component] = body
+            waiters[component] = self.messenger.watch([component], augur(condition), deadline, current)
+        sent = time.time()
+        try:
+            await asyncio.gather(*[self.messenger.command(request_type="ChangeState", component=component, body=body)
+                                   for component, body in bodies.items()])
+            await asyncio.wait([waiter.future for waiter in waiters.values()],
+                               timeout=max(deadline - loop.time(), 0))
+        except ConnectionError:
+            for component in changes:
+                latency.miss(component, "ChangeState", 'confirm', rig=rig)
+            raise
+        finally:
+            for waiter in waiters.values():
+                self.messenger.unwatch(waiter)
+        unconfirmed = [component for component, waiter in waiters.items() if not waiter.future.done()]
+        if unconfirmed:
+            for component in unconfirmed:
+                latency.miss(component, "ChangeState", 'confirm', rig=rig)
+            logger.error(f"Changes to {unconfirmed} not confirmed within timeout {timeout}")
+            pub_err(unconfirmed)
+        clock = self.messenger.clock
+        onset = clock.to_hardware(sent)
+        for component, waiter in waiters.items():
+            comp, message, received, stamp = waiter.future.result()
+            if received >= sent:
+                latency.record(component, "ChangeState", 'confirm', received - sent, rig=rig)
+            else:  # confirmed by the last known state, see effect()
+                stamp = onset
+            if (onset is not None) and (stamp is not None):
+                timer = max(stamp - onset, 0.0)
+            else:
+                timer = max(received - sent, 0.0)
+            omens[component] = Omen(component, True, message, timer, onset, stamp, clock.offset, received)
+        logger.state(f"Changes to {list(changes)} confirmed by decide-rs")
+        return omens
 
     async def set_feeder(self, duration):
         """
@@ -109,8 +267,7 @@ class Morgoth:
                                                       body=None)
         if int(interval_check['timeout']) != duration:
             logger.error(f"Stepper motor timeout parameter not set to {duration}")
-        global FEED_TIME
-        FEED_TIME = duration
+        self.feed_time = duration
 
     async def set_light(self, interval=300000):
         """
@@ -131,9 +288,7 @@ class Morgoth:
             logger.error(f"House-Light Clock Interval not set to {interval},"
                          f" got {interval_check['clock_interval']}")
         logger.debug("Parameters Set & Checked for House-lights. Requesting Current State")
-        current_lights = await self.messenger.command(request_type="GetState",
-                                                      component='house-light',
-                                                      body={})
+        current_lights = await self.messenger.state('house-light')
         logger.debug(f"State Request Received, decoded: {current_lights}")
         self.sun.update(current_lights)
         asyncio.create_task(self._light_cycle())
@@ -175,58 +330,48 @@ class Morgoth:
         """
         logger.state('Feed requested')
         await asyncio.sleep(delay)
-        b = asyncio.create_task(self.messenger.command(
-            request_type="ChangeState",
-            component='stepper-motor',
-            body={'running': True, 'direction': True}
-        ))
-        a = asyncio.create_task(self.scry(
-            'stepper-motor',
-            condition=lambda pub: pub['running'] is True,
-            failure=pub_err,
-            timeout=TIMEOUT
-        ))
-        await asyncio.gather(a, b)
+        await self.effect('stepper-motor',
+                          body={'running': True, 'direction': True},
+                          condition={'running': True},
+                          force=True)
         logger.state('feeding confirmed by decide-rs, awaiting motor stop')
         await self.scry(
             'stepper-motor',
-            condition=lambda pub: not pub['running'],
+            condition={'running': False},
             failure=pub_err,
-            timeout=FEED_TIME + TIMEOUT
+            timeout=self.feed_time + TIMEOUT
         )
         logger.state('motor stop confirmed by decide-rs')
         return
 
-    async def cue(self, loc, color):
+    async def cue(self, loc, color, force=False):
         """
         Activate led at specific location
         :param loc: str, location. Input string will be checked by "peck_parse()"
         :param color: ['red','blue','green','all','off']
-        :return:
+        :param force: bool, if True request the color even if the led already shows it
+        :return: decide-rs timestamp (s) of the confirmation that the cue is lit, or of the request if it already
+                 was, for use as an onset. None if decide-rs' clock isn't known yet
         """
         pos = peck_parse(loc, mode='l')
         logger.state(f'Requesting cue {pos}')
-        a = asyncio.create_task(self.scry(
-            pos,
-            condition=lambda pub: pub['led_state'] == color,
-            failure=pub_err,
-            timeout=TIMEOUT
-        ))
-        b = asyncio.create_task(self.messenger.command(
-            request_type="ChangeState",
-            component=pos,
-            body={'led_state': color}
-        ))
-        await asyncio.gather(a, b)
-        return
-
-    async def cues_off(self):
+        lit = await self.effect(pos,
+                                body={'led_state': color},
+                                condition={'led_state': color},
+                                current=True,
+                                force=force)
+        return lit.stamp
+
+    async def cues_off(self, force=False):
         """
         Sets all LED cues to off
+        :param force: bool, if True request it even for leds already off
         :return:
         """
-        for pos in ['peck-leds-left', 'peck-leds-right', 'peck-leds-center']:
-            await self.cue(pos, 'off')
+        await self.transact({pos: {'led_state': 'off'}
+                             for pos in ['peck-leds-left', 'peck-leds-right', 'peck-leds-center']},
+                            current=True,
+                            force=force)
 
     async def _light_cycle(self):
         """
@@ -234,63 +379,49 @@ class Morgoth:
         Should be run within a create_task() or gather() and not blocking-awaited
         """
         try:
+            self.messenger.wake()
             while True:
-                *_topic, msg = await self.messenger.lighter.recv_multipart()
+                _state, _comp, msg, _received = await self.messenger.lit.get()
                 logger.state("House-light Message Received")
-                await asyncio.sleep(0.01)
-                proto_comp = Component("state", "house-light")
-                _tstamp, state_msg = await proto_comp.from_pub(msg)
-                decoded = MessageToDict(state_msg,
-                                        including_default_value_fields=True,
-                                        preserving_proto_field_name=True)
+                _tstamp, state_msg = parser("state", "house-light").from_pub(msg)
+                decoded = decode(state_msg)
                 self.sun.update(decoded)
                 logger.state("House-light state updated")
         except asyncio.CancelledError:
             logger.warning("Light Cycle has been cancelled due to another task's failure.")
 
-    async def blip(self, duration, brightness=0):
+    async def blip(self, duration, brightness=0, force=False):
         """
         Turn off house lights for duration. Alternatively, set houselight to specific level.
         :param duration:
         :param brightness: optional, defaults to 0
+        :param force: bool, if True request the change even if the house lights are already at brightness
         :return:
         """
         logger.state("Manually changing house lights")
-        a = asyncio.create_task(self.scry(
-            'house-light',
-            condition=lambda pub: (pub['manual']) and (pub['brightness'] == brightness),
-            failure=pub_err,
-            timeout=TIMEOUT
-        ))
-
-        b = asyncio.create_task(self.messenger.command(
-            request_type="ChangeState",
-            component='house-light',
-            body={'manual': True, 'brightness': brightness}
-        ))
-        await asyncio.gather(a, b)
+        await self.effect('house-light',
+                          body={'manual': True, 'brightness': brightness},
+                          condition={'manual': True, 'brightness': brightness},
+                          current=True,
+                          force=force)
         logger.state("Manually changing house lights confirmed by decide-rs.")
 
         await asyncio.sleep(duration / 1000)
 
         logger.state("Returning house lights to cycle")
-        a = asyncio.create_task(self.scry(
-            'house-light',
-            condition=lambda pub: not pub['manual'],
-            failure=pub_err,
-        ))
-        b = asyncio.create_task(self.messenger.command(
-            request_type="ChangeState",
-            component='house-light',
-            body={'manual': False, 'dyson': True}
-        ))
-        await asyncio.gather(a, b)
+        await self.effect('house-light',
+                          body={'manual': False, 'dyson': True},
+                          condition={'manual': False},
+                          current=True,
+                          timeout=None,
+                          force=force)
         logger.state("Returning house lights to cycle succeeded")
 
     async def play(self, stim=None, poll_end=True):
         """
         play specified stimuli, or last played stimuli if not specified.
         Automatically awaits the stimuli end message, but can be ignored for interruption.
+        decide-rs timestamps of the start and end are kept in playback.started and playback.ended
         :param stim: name of stimuli, to be used in conjunction with playback's iterator.
         :param poll_end: True to return after stimuli end, False to return as soon as stimuli starts
         :return:
@@ -298,56 +429,64 @@ class Morgoth:
         if stim is None:
             stim = self.playback.stimulus
         logger.state(f"Playback of {stim} requested")
-        b = asyncio.create_task(self.messenger.command(
-            request_type="ChangeState",
-            component='audio-playback',
-            body={'audio_id': stim, 'playback': True}
-        ))
-        a = asyncio.create_task(self.scry(
-            'audio-playback',
-            condition=lambda msg: ('audio_id' in msg)
-                                  and ('playback' in msg)
-                                  and (msg['audio_id'] == stim)
-                                  and (msg['playback']),
-            failure=pub_err,
-            timeout=TIMEOUT
-        ))
-        await b
-        _, _, pub, _ = await a
-        frame_count = int(pub['frame_count'])
+        begun = await self.effect('audio-playback',
+                                  body={'audio_id': stim, 'playback': True},
+                                  condition={'audio_id': stim, 'playback': True},
+                                  force=True)
+        frame_count = int(begun.message['frame_count'])
         stim_duration = frame_count / self.playback.sample_rate
         self.playback.stim_len = stim_duration
+        self.playback.started = begun.stamp
+        self.playback.ended = None
         if poll_end:
-            await asyncio.create_task(self.scry(
+            over = await asyncio.create_task(self.scry(
                 'audio-playback',
-                condition=lambda msg: ('playback' in msg) and (msg['playback'] is False),
+                condition={'playback': False},
                 failure=pub_err,
                 timeout=stim_duration * 1000 + TIMEOUT
             ))
+            self.playback.ended = over.stamp
         else:
             return
 
-    async def stop(self):
+    async def stop(self, force=False):
         """
         Request stimuli stop
+        :param force: bool, if True request it even if decide-rs already reported playback over
         :return:
         """
         logger.state("Requesting playback stop.")
-        a = asyncio.create_task(self.scry(
-            'audio-playback',
-            condition=lambda msg: ('playback' in msg) and (msg['playback'] is False),
-            failure=pub_err,
-            timeout=TIMEOUT
-        ))
-        b = asyncio.create_task(self.messenger.command(
-            request_type="ChangeState",
-            component='audio-playback',
-            body={'playback': 0}
-        ))
-        await asyncio.gather(a, b)
+        await self.effect('audio-playback',
+                          body={'playback': 0},
+                          condition={'playback': False},
+                          current=True,
+                          force=force)
         return
 
 
+def augur(condition, raw=False):
+    """
+    Turn a scry condition into a test of parsed protobuf messages
+    :param condition: dict of {field: value}, or fn
+    :param raw: bool, if True fn takes the parsed protobuf message, otherwise the decoded dict
+    :return: fn, True if the parsed message satisfies the condition
+    """
+    if isinstance(condition, dict):
+        fields = tuple(condition)
+        values = tuple(condition.values())
+
+        def spec(message):
+            try:
+                return tuple(getattr(message, field) for field in fields) == values
+            except AttributeError:  # message from another component
+                return False
+        return spec
+    elif raw:
+        return lambda message: condition(message) is True
+    else:
+        return lambda message: condition(decode(message)) is True
+
+
 class Sun:
     def __init__(self, interval):
         self.manual = False
@@ -375,6 +514,8 @@ class JukeBox:
         self.dir = None
         self.cue_locations = None
         self.stim_len = 0
+        self.started = None
+        self.ended = None
 
     @classmethod
     async def spawn(cls, cfg, shuffle=True, replace=False, get_cues=True):
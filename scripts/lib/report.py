@@ -2,6 +2,8 @@ import logging
 import asyncio, socket
 import json
 from .config import *
+from . import metrics
+from . import rig as rigs
 
 logger = logging.getLogger('main')
 
@@ -12,7 +14,8 @@ def make_response(info=None):
     """
     if info is None:
         info = {'state': {}, 'params': {}}
-    info.update({'script': __name__, 'device': IDENTITY})
+    rig = rigs.current()
+    info.update({'script': __name__, 'device': rig.identity, 'metrics': metrics.snapshot(rig.name)})
     return info
 
 
@@ -27,7 +30,7 @@ async def set_server(snd_resp=make_response, variables=None):
     """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        server.bind(('', PORT_CTRL))
+        server.bind(('', rigs.current().port_ctrl))
     except OSError:
         raise OSError("Port Ctrl Address Already in Use. Check for other running scripts.")
     server.listen(1)
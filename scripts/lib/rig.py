@@ -0,0 +1,54 @@
+import contextvars
+from .config import *
+
+
+class Rig:
+    """
+    Settings of one operant box. A script driving a single box runs with the defaults from config.yml,
+    the supervisor runs each of its boxes with their own.
+    """
+    def __init__(self, name=None, identity=IDENTITY, req_endpoint=REQ_ENDPOINT, pub_endpoint=PUB_ENDPOINT,
+                 port_ctrl=PORT_CTRL):
+        """
+        :param name: str, label of the box in logs and metrics, None for a script driving a single box
+        :param identity: str, address records are stamped with for Decide-Host
+        :param req_endpoint: str, decide-rs request endpoint
+        :param pub_endpoint: str, decide-rs publisher endpoint
+        :param port_ctrl: int, port of the report server
+        """
+        self.name = name
+        self.identity = identity
+        self.req_endpoint = req_endpoint
+        self.pub_endpoint = pub_endpoint
+        self.port_ctrl = port_ctrl
+
+    def __repr__(self):
+        return f"Rig({self.name or self.identity})"
+
+
+default = Rig()
+# Rig whose task is running. Tasks inherit it from the task that created them,
+# so everything a box's script starts is attributed to that box
+_current = contextvars.ContextVar('rig', default=default)
+
+
+def current():
+    return _current.get()
+
+
+def enter(rig):
+    """
+    Make rig the current one, until reset with the returned token
+    """
+    return _current.set(rig)
+
+
+def leave(token):
+    _current.reset(token)
+
+
+def supervised():
+    """
+    :return: bool, True when running under the supervisor rather than as a standalone script
+    """
+    return _current.get() is not default
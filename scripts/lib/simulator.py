@@ -0,0 +1,384 @@
+import os
+import json
+import math
+import time
+import wave
+import random
+import asyncio
+import logging
+import zmq
+import zmq.asyncio
+from .config import *
+from .decrypt import registry
+from .dispatch import RequestType
+from .generator_hex import decide_pb2 as dc_pb
+
+logger = logging.getLogger('main')
+
+KEYS = ['peck_left', 'peck_center', 'peck_right']
+
+
+class Simulator:
+    """
+    Stand-in for decide-rs, serving its REQ/PUB protocol without a box, for load tests and benchmarks.
+    Components are modelled from what the scripts rely on: house-light ticks of the clock interval,
+    stepper-motor runs ending after their timeout, LED states, audio playback lasting the stimulus'
+    frame count, and pecks that are scripted, random or triggered with peck().
+    """
+    def __init__(self, req_endpoint=REQ_ENDPOINT, pub_endpoint=PUB_ENDPOINT, latency=0.0, jitter=0.0,
+                 sample_rate=44100, stim_duration=2.0, load_time=0.02, pecks=None, peck_rate=0.0, hold=0.05,
+                 seed=None, serial=True, context=None):
+        """
+        :param req_endpoint: str, endpoint to serve requests on
+        :param pub_endpoint: str, endpoint to publish state changes on
+        :param latency: seconds every reply and state change is delayed by
+        :param jitter: seconds, up to which a uniformly random delay is added to latency
+        :param sample_rate: int, sample rate (Hz) reported by audio-playback
+        :param stim_duration: seconds a stimulus plays for when its wav file can't be read
+        :param load_time: seconds taken per stimulus to load a config set through audio-playback's conf_path
+        :param pecks: optional, list of (seconds from start, key) pecks, key being one of KEYS
+        :param peck_rate: random pecks per second on a random key, 0 for none
+        :param hold: seconds a key stays pecked before it is released
+        :param seed: optional, seed of the random pecks and jitter
+        :param serial: bool, if True handle one request at a time in the order they arrive, as decide-rs does,
+                       so a slow request holds up those behind it. If False handle them concurrently
+        :param context: optional, zmq.asyncio.Context
+        """
+        self.req_endpoint = req_endpoint
+        self.pub_endpoint = pub_endpoint
+        self.latency = latency
+        self.jitter = jitter
+        self.pecks = sorted(pecks or [])
+        self.peck_rate = peck_rate
+        self.hold = hold
+        self.serial = serial
+        self.random = random.Random(seed)
+        self.context = context or zmq.asyncio.Context.instance()
+        self.router = None
+        self.publisher = None
+        self.tasks = []
+        # state changes awaiting publication, in order, as (due loop time, topic, message)
+        self.outbox = None
+        self.due = 0.0
+        self.served = 0
+        self.published = 0
+        self.components = {
+            'house-light': HouseLight(self),
+            'stepper-motor': StepperMotor(self),
+            'peck-keys': PeckKeys(self, 'peck-keys'),
+            'audio-playback': AudioPlayback(self, sample_rate, stim_duration, load_time),
+        }
+        for led in ['peck-leds-left', 'peck-leds-right', 'peck-leds-center']:
+            self.components[led] = Led(self, led)
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    async def run(self):
+        """
+        Bind and serve until cancelled
+        """
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind(self.req_endpoint)
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.bind(self.pub_endpoint)
+        self.outbox = asyncio.Queue()
+        logger.info(f"Simulating decide-rs on {self.req_endpoint} and {self.pub_endpoint}")
+        try:
+            await asyncio.gather(self._serve(),
+                                 self._send(),
+                                 self.components['house-light'].cycle(),
+                                 self._script(),
+                                 self._shower())
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            self.router.close(linger=0)
+            self.publisher.close(linger=0)
+
+    def later(self, coroutine):
+        """
+        Run coroutine as a task cancelled along with the simulator
+        """
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        task.add_done_callback(self.tasks.remove)
+        return task
+
+    async def _serve(self):
+        while True:
+            frames = await self.router.recv_multipart()
+            if self.serial:
+                await self._answer(frames)
+            else:
+                self.later(self._answer(frames))
+
+    async def _answer(self, frames):
+        # DEALER requests: request id, empty delimiter, version, request type, body, component
+        identity, request_id, _delimiter, version, request_type, body, *component = frames
+        reply = dc_pb.Reply()
+        busy = 0.0
+        try:
+            busy = self.handle(version, int.from_bytes(request_type, 'little'), body,
+                               component[0].decode('utf-8') if component else None, reply)
+        except Exception as e:
+            reply.error = str(e)
+        await asyncio.sleep(busy)
+        # the reply is under way while the next request is handled
+        self.later(self._reply([identity, request_id, b"", DECIDE_VERSION, reply.SerializeToString()]))
+
+    async def _reply(self, frames):
+        await asyncio.sleep(self.delay())
+        self.served += 1
+        await self.router.send_multipart(frames)
+
+    def handle(self, version, request_type, body, component, reply):
+        """
+        Carry out a request, filling in its reply. Raises ValueError for requests decide-rs would refuse
+        :return: seconds the request keeps decide-rs busy before it replies
+        """
+        if version != DECIDE_VERSION:
+            raise ValueError(f"Unsupported protocol version {version}")
+        request_type = RequestType(request_type)
+        if request_type in [RequestType.RequestLock, RequestType.ReleaseLock]:
+            reply.ok.SetInParent()
+            return 0.0
+        if component not in self.components:
+            raise ValueError(f"Unknown component {component}")
+        device = self.components[component]
+        busy = 0.0
+        if request_type == RequestType.ChangeState:
+            change = dc_pb.StateChange()
+            change.ParseFromString(body)
+            state = registry[component]['state']()
+            change.state.Unpack(state)
+            device.change(state)
+            reply.ok.SetInParent()
+        elif request_type == RequestType.GetState:
+            reply.state.Pack(device.state)
+        elif request_type == RequestType.ResetState:
+            device.reset()
+            reply.ok.SetInParent()
+        elif request_type == RequestType.SetParameters:
+            change = dc_pb.ComponentParams()
+            change.ParseFromString(body)
+            params = registry[component]['param']()
+            change.parameters.Unpack(params)
+            busy = device.configure(params) or 0.0
+            reply.ok.SetInParent()
+        elif request_type == RequestType.GetParameters:
+            reply.params.Pack(device.params)
+        else:
+            raise ValueError(f"Unsupported request {request_type.name}")
+        return busy
+
+    def publish(self, component, state):
+        """
+        Publish a copy of a component's state once the simulated latency has passed.
+        Jitter delays but never reorders publications, as with decide-rs' single publisher
+        """
+        pub = dc_pb.Pub()
+        pub.time.GetCurrentTime()
+        pub.state.Pack(state)
+        self.due = max(asyncio.get_running_loop().time() + self.delay(), self.due)
+        self.outbox.put_nowait((self.due, f"state/{component}".encode('utf-8'), pub.SerializeToString()))
+
+    async def _send(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            due, topic, msg = await self.outbox.get()
+            await asyncio.sleep(max(due - loop.time(), 0))
+            self.published += 1
+            await self.publisher.send_multipart([topic, msg])
+
+    def peck(self, key, hold=None):
+        """
+        Press a key and release it hold seconds later
+        """
+        self.components['peck-keys'].peck(key, self.hold if hold is None else hold)
+
+    async def _script(self):
+        start = asyncio.get_running_loop().time()
+        for at, key in self.pecks:
+            await asyncio.sleep(max(start + at - asyncio.get_running_loop().time(), 0))
+            self.peck(key)
+
+    async def _shower(self):
+        if not self.peck_rate:
+            return
+        while True:
+            await asyncio.sleep(self.random.expovariate(self.peck_rate))
+            self.peck(self.random.choice(KEYS))
+
+    def stats(self):
+        return {'served': self.served, 'published': self.published}
+
+
+class Device:
+    """
+    Simulated component, holding its current state and params messages
+    """
+    def __init__(self, simulator, name):
+        self.simulator = simulator
+        self.name = name
+        self.state = registry[name]['state']()
+        self.params = registry[name]['param']()
+
+    def change(self, state):
+        self.state.CopyFrom(state)
+        self.publish()
+
+    def reset(self):
+        self.state.Clear()
+        self.publish()
+
+    def configure(self, params):
+        """
+        :return: optional, seconds taken to apply params
+        """
+        self.params.CopyFrom(params)
+
+    def publish(self):
+        self.simulator.publish(self.name, self.state)
+
+
+class Led(Device):
+    pass
+
+
+class PeckKeys(Device):
+    def peck(self, key, hold):
+        if key not in KEYS:
+            raise ValueError(f"Unknown key {key}, expected one of {KEYS}")
+        setattr(self.state, key, True)
+        self.publish()
+        self.simulator.later(self._release(key, hold))
+
+    async def _release(self, key, hold):
+        await asyncio.sleep(hold)
+        setattr(self.state, key, False)
+        self.publish()
+
+
+class HouseLight(Device):
+    """
+    Follows the time of day, ramping up from dawn to noon and back down to dusk,
+    unless set manually. Its state is published every clock interval.
+    """
+    DAWN = 7
+    DUSK = 19
+    MAX = 255
+
+    def __init__(self, simulator):
+        super().__init__(simulator, 'house-light')
+        self.params.clock_interval = 300
+        self.state.dyson = True
+        self.follow()
+
+    def follow(self):
+        hour = time.localtime().tm_hour + time.localtime().tm_min / 60
+        self.state.daytime = self.DAWN <= hour < self.DUSK
+        if self.state.daytime:
+            self.state.brightness = round(self.MAX * math.sin(math.pi * (hour - self.DAWN) / (self.DUSK - self.DAWN)))
+        else:
+            self.state.brightness = 0
+
+    def change(self, state):
+        self.state.manual = state.manual
+        self.state.dyson = state.dyson
+        if state.manual:
+            self.state.brightness = state.brightness
+        else:
+            self.follow()
+        self.publish()
+
+    def reset(self):
+        self.state.manual = False
+        self.state.dyson = True
+        self.follow()
+        self.publish()
+
+    async def cycle(self):
+        while True:
+            await asyncio.sleep(max(self.params.clock_interval, 0.001))
+            if not self.state.manual:
+                self.follow()
+                self.publish()
+
+
+class StepperMotor(Device):
+    """
+    Runs until stopped, or for its timeout (ms) if it has one
+    """
+    def __init__(self, simulator):
+        super().__init__(simulator, 'stepper-motor')
+        self.run = None
+
+    def change(self, state):
+        if self.run is not None:
+            self.run.cancel()
+            self.run = None
+        super().change(state)
+        if state.running and self.params.timeout:
+            self.run = self.simulator.later(self._stop(self.params.timeout / 1000))
+
+    async def _stop(self, after):
+        await asyncio.sleep(after)
+        self.run = None
+        self.state.running = False
+        self.publish()
+
+
+class AudioPlayback(Device):
+    """
+    Plays stimuli of the config set through its conf_path param, each lasting its wav file's frame count.
+    Setting a config takes load_time per stimulus, as decide-rs reads every stimulus of it
+    """
+    def __init__(self, simulator, sample_rate, stim_duration, load_time):
+        super().__init__(simulator, 'audio-playback')
+        self.params.sample_rate = sample_rate
+        self.stim_duration = stim_duration
+        self.load_time = load_time
+        self.frames = {}
+        self.playing = None
+
+    def configure(self, params):
+        if params.conf_path:
+            with open(params.conf_path) as file:
+                cf = json.load(file)
+            self.frames = {stim['name']: self._frame_count(cf['stimulus_root'], stim['name'])
+                           for stim in cf['stimuli']}
+        self.params.conf_path = params.conf_path
+        self.params.audio_count = len(self.frames)
+        return self.load_time * len(self.frames) if params.conf_path else 0.0
+
+    def _frame_count(self, root, name):
+        for path in [os.path.join(root, name), os.path.join(root, f"{name}.wav")]:
+            try:
+                with wave.open(path, 'rb') as file:
+                    return round(file.getnframes() * self.params.sample_rate / file.getframerate())
+            except (OSError, EOFError, wave.Error):
+                continue
+        return round(self.stim_duration * self.params.sample_rate)
+
+    def change(self, state):
+        if self.playing is not None:
+            self.playing.cancel()
+            self.playing = None
+        if not state.playback:
+            self.state.playback = False
+            self.publish()
+            return
+        if state.audio_id not in self.frames:
+            raise ValueError(f"Unknown stimulus {state.audio_id}")
+        self.state.audio_id = state.audio_id
+        self.state.playback = True
+        self.state.frame_count = self.frames[state.audio_id]
+        self.publish()
+        self.playing = self.simulator.later(self._end(self.state.frame_count / self.params.sample_rate))
+
+    async def _end(self, after):
+        await asyncio.sleep(after)
+        self.playing = None
+        self.state.playback = False
+        self.publish()
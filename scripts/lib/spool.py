@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+
+logger = logging.getLogger('main')
+
+
+class Spool:
+    """
+    Append-only JSON-lines store for records that could not be sent to Decide-Host.
+    Records are only ever appended; replay progress is kept as a byte offset in a
+    separate cursor file, so records already sent are skipped without rewriting the spool.
+    The spool is compacted once enough of it has been replayed.
+    """
+    def __init__(self, path, sync_every=32, sync_interval=1.0, compact_at=4 * 2**20):
+        """
+        :param path: spool file, the cursor is kept next to it
+        :param sync_every: fsync after this many appended records...
+        :param sync_interval: ...or at most this many seconds after the last fsync, so that the
+                              end of a burst of records is synced too, without another record to follow it
+        :param compact_at: bytes of replayed records to accumulate before compacting
+        """
+        self.path = path
+        self.cursor_path = f"{path}.cursor"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_at = compact_at
+        self.file = open(self.path, 'ab')
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.timer = None
+        self._repair()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n')
+        # flushed to the OS on every record so that a crashed process loses nothing,
+        # fsync is batched as only a power loss can lose what the OS holds
+        self.file.flush()
+        self.unsynced += 1
+        since = time.monotonic() - self.last_sync
+        if (self.unsynced >= self.sync_every) or (since > self.sync_interval):
+            self.sync()
+        elif self.timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:  # appended outside of an event loop, left to the next append or sync()
+                return
+            self.timer = loop.call_later(self.sync_interval - since, self.sync)
+
+    def sync(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def pending(self):
+        """
+        Iterate over the records not yet replayed
+        :return: generator of (offset, record), commit offset once the record has been sent
+        """
+        self.file.flush()
+        with open(self.path, 'rb') as reader:
+            reader.seek(self.cursor())
+            while True:
+                line = reader.readline()
+                if not line.endswith(b'\n'):  # end of spool, or a record cut short by a crash
+                    return
+                offset = reader.tell()
+                try:
+                    yield offset, json.loads(line)
+                except ValueError:
+                    logger.error(f"Skipping unreadable record in {self.path} ending at byte {offset}")
+
+    def cursor(self):
+        try:
+            with open(self.cursor_path, 'r') as file:
+                mark = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return 0
+        # a cursor left over from before a compaction refers to another file
+        if mark.get('inode') != os.fstat(self.file.fileno()).st_ino:
+            return 0
+        return mark['offset']
+
+    def checkpoint(self, offset):
+        """
+        Mark everything up to offset as replayed, safe to call while iterating over pending()
+        """
+        self._mark(offset)
+
+    def commit(self, offset):
+        """
+        Mark everything up to offset as replayed, compacting the spool if enough has been.
+        Only call once done iterating over pending()
+        """
+        size = os.fstat(self.file.fileno()).st_size
+        if offset >= size:
+            self._truncate()
+        elif (offset >= self.compact_at) and (offset * 2 >= size):
+            self._compact(offset)
+        else:
+            self._mark(offset)
+
+    def backlog(self):
+        """
+        :return: bytes of records awaiting replay
+        """
+        self.file.flush()
+        return os.fstat(self.file.fileno()).st_size - self.cursor()
+
+    def _repair(self):
+        """
+        Cut off a record left half-written by a crash, so the next one isn't appended onto it
+        """
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            return
+        with open(self.path, 'rb') as reader:
+            tail = max(0, size - 2**16)
+            reader.seek(tail)
+            chunk = reader.read()
+        if chunk.endswith(b'\n'):
+            return
+        end = chunk.rfind(b'\n')
+        end = tail + end + 1 if end >= 0 else 0
+        logger.warning(f"Discarding {size - end} bytes of a partly written record in {self.path}")
+        self.file.truncate(end)
+
+    def _mark(self, offset):
+        inode = os.fstat(self.file.fileno()).st_ino
+        temp = f"{self.cursor_path}.tmp"
+        with open(temp, 'w') as file:
+            json.dump({'offset': offset, 'inode': inode}, file)
+        os.replace(temp, self.cursor_path)
+
+    def _truncate(self):
+        # cursor first, a crash in between then only replays records again rather than skipping new ones
+        self._mark(0)
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+
+    def _compact(self, offset):
+        logger.debug(f"Compacting {self.path}, discarding {offset} replayed bytes")
+        self.sync()
+        temp = f"{self.path}.tmp"
+        with open(self.path, 'rb') as reader, open(temp, 'wb') as writer:
+            reader.seek(offset)
+            shutil.copyfileobj(reader, writer)
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.replace(temp, self.path)
+        self.file.close()
+        self.file = open(self.path, 'ab')
+        self._mark(0)
@@ -0,0 +1,122 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from .config import *
+from . import metrics
+from .latency import Histogram
+
+logger = logging.getLogger('main')
+
+LOOPS = ['asyncio', 'uvloop']
+
+
+def run(main, loop=EVENT_LOOP):
+    """
+    Run a coroutine as asyncio.run() does, on the event loop chosen, kept watch over by a Vigil
+    :param main: coroutine, e.g. a script's main()
+    :param loop: str, one of LOOPS. uvloop falls back on asyncio's own loop when it isn't installed
+    """
+    if loop not in LOOPS:
+        raise ValueError(f"Unknown event loop {loop}, expected one of {LOOPS}")
+    if loop == 'uvloop':
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logger.warning("uvloop is not installed, running on the asyncio event loop")
+            loop = 'asyncio'
+    return asyncio.run(_watched(main, loop))
+
+
+async def _watched(main, loop):
+    vigil = Vigil(loop)
+    vigil.start()
+    try:
+        return await main
+    finally:
+        vigil.stop()
+
+
+class Vigil:
+    """
+    Keeps watch over the running event loop, so that calls blocking it, and delaying every trial's timing
+    along with it, can be found. A sampler task sleeps interval at a time and records how late it wakes in
+    a histogram: the time ready callbacks wait for the loop. A watchdog thread logs the stack of the loop's
+    thread whenever the sampler is threshold late, i.e. while one callback blocks, then how long it blocked:
+    from when the sampler was due to when it woke. Both are served under metrics as loop_lag.
+    """
+    def __init__(self, loop='asyncio', interval=LAG_INTERVAL, threshold=BLOCK_THRESHOLD):
+        """
+        :param loop: str, name of the event loop, for the metrics
+        :param interval: seconds between samples of the loop's lag
+        :param threshold: seconds a callback may block the loop before its stack is logged, 0 for no watchdog
+        """
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = Histogram(low=1e-5)
+        self.blocked = 0
+        # monotonic time the sampler is due to wake next, the due time of the last stall reported by the watchdog,
+        # and the time the sampler woke after that stall, for the watchdog to report
+        self.due = time.monotonic()
+        self.stall = None
+        self.resumed = None
+        self.sampler = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        Start watching the running event loop. The sampler is due at once, so that a call blocking the loop
+        before the sampler first runs, e.g. loading a script, counts as well
+        """
+        self.due = time.monotonic()
+        self.sampler = asyncio.create_task(self._sample())
+        if self.threshold:
+            self.watchdog = threading.Thread(target=self._watch, args=(threading.get_ident(),),
+                                             name='vigil', daemon=True)
+            self.watchdog.start()
+        metrics.register('loop_lag', self.stats)
+        logger.info(f"Running on the {self.loop} event loop, sampling its lag every {self.interval * 1000:.0f} ms")
+
+    def stop(self):
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.cancel()
+        stats = self.stats()
+        if stats['count']:
+            logger.info(f"Event loop lag p50 {stats['p50'] * 1000:.2f} ms, p99 {stats['p99'] * 1000:.2f} ms, "
+                        f"max {stats['max'] * 1000:.2f} ms, {self.blocked} blocking calls")
+
+    async def _sample(self):
+        while True:
+            woke = time.monotonic()
+            self.lag.record(max(woke - self.due, 0.0))
+            if self.due == self.stall:
+                self.resumed = woke
+            self.due = woke + self.interval
+            await asyncio.sleep(self.interval)
+
+    def _watch(self, ident):
+        while not self.stopped.wait(self.threshold / 2):
+            if self.resumed is not None:
+                logger.warning(f"Event loop was blocked for {(self.resumed - self.stall) * 1000:.0f} ms")
+                self.resumed = None
+            due = self.due
+            stalled = time.monotonic() - due
+            if (stalled < self.threshold) or (due == self.stall):
+                continue
+            # one report per stall, with the stack the loop's thread is blocked in as it goes on
+            self.stall = due
+            self.blocked += 1
+            frame = sys._current_frames().get(ident)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else "unavailable\n"
+            logger.warning(f"Event loop blocked for over {stalled * 1000:.0f} ms, in:\n{stack}")
+
+    def stats(self):
+        stats = self.lag.stats()
+        del stats['missed']
+        return {'loop': self.loop, 'interval': self.interval, 'blocked': self.blocked, **stats}
@@ -8,6 +8,8 @@ from lib.logging import lincoln
 from lib.process import *
 from lib.dispatch import *
 from lib.report import set_server
+from lib.rig import supervised, current
+from lib.vigil import run
 
 __name__ = 'lights'
 
@@ -47,9 +49,9 @@ async def main():
     # House-lights
     await decider.set_light()
 
-    logging.info("Lights.py is initiated")
+    logger.info("Lights.py is initiated")
     if not args.no_notify:
-        slack(f"lights.py was initiated on {IDENTITY}", usr=args.user)
+        slack(f"lights.py was initiated on {current().identity}", usr=args.user)
 
     try:
         if args.feed:
@@ -62,21 +64,19 @@ async def main():
         else:
             await decider.messenger.eye()
     except Exception as error:
-        import traceback
-        logger.error(f"Error encountered: {error}")
-        print(traceback.format_exc())
+        logger.exception(f"Error encountered: {error}")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client encountered an error and will shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client encountered an error and will shut down.", usr=args.user)
         sys.exit("Error Detected, shutting down.")
 
 
-if __name__ == "lights":
+if (__name__ == "lights") and not supervised():
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.warning("Keyboard Interrupt Detected, shutting down.")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client was manually shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client was manually shut down.", usr=args.user)
         sys.exit("Keyboard Interrupt Detected, shutting down.")
 
 
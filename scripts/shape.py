@@ -8,6 +8,8 @@ from lib.logging import lincoln
 from lib.process import *
 from lib.dispatch import *
 from lib.report import set_server
+from lib.rig import supervised, current
+from lib.vigil import run
 
 __name__ = 'shape'
 
@@ -61,12 +63,14 @@ async def main():
     # Start logging for messages
     await contact_host()
     # Initialize components
-    await decider.set_light()
-    await decider.set_feeder(duration=params['feed_duration'])
+    await asyncio.gather(
+        decider.set_light(),
+        decider.set_feeder(duration=params['feed_duration']),
+    )
 
     logger.info(f"{__name__} initiated")
     if not args.no_notify:
-        slack(f"{__name__} was initiated on {IDENTITY}", usr=args.user)
+        slack(f"{__name__} was initiated on {current().identity}", usr=args.user)
 
     try:
         await asyncio.gather(
@@ -76,11 +80,9 @@ async def main():
             return_exceptions=False
         )
     except Exception as error:
-        import traceback
-        logger.error(f"Error encountered: {error}")
-        print(traceback.format_exc())
+        logger.exception(f"Error encountered: {error}")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client encountered an error and will shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client encountered an error and will shut down.", usr=args.user)
         sys.exit("Error Detected, shutting down.")
 
 
@@ -143,17 +145,12 @@ async def block1_patience():
     if state['trial'] == 0:
         logger.info(f"Entering block {state['block']}")
 
-    await decider.cue(cue_pos, params['cue_color'])
+    cued = await decider.cue(cue_pos, params['cue_color'])
 
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
-
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=params['response_duration'])
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={await_input: True},
+                                                        timeout=params['response_duration'],
+                                                        since=cued)
 
     # feed regardless of response
     await decider.cue(cue_pos, 'off')
@@ -195,17 +192,12 @@ async def block2_peck():
     if state['trial'] == 0:
         logger.info(f"Entering block {state['block']}")
 
-    await decider.cue(cue_pos, params['cue_color'])
-
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
+    cued = await decider.cue(cue_pos, params['cue_color'])
 
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=None)
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={await_input: True},
+                                                        timeout=None,
+                                                        since=cued)
 
     # feed regardless of response
     await decider.cue(await_input, 'off')
@@ -239,30 +231,27 @@ async def block3_extend():
     await_input = peck_parse(params['init_position'], 'r')
     await decider.cue(params['init_position'], params['cue_color'])
 
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
-
     await decider.scry('peck-keys',
-                       condition=resp_check,
+                       condition={await_input: True},
                        timeout=None)
-    await decider.cue(params['init_position'], 'off')
-
     cue2 = pick(params['response_position'])
     second_input = peck_parse(cue2, 'r')
-    await decider.cue(cue2, params['cue_color'])
-
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == second_input):
-                return True
-            return False
-
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=None)
+    first, second = peck_parse(params['init_position'], 'l'), peck_parse(cue2, 'l')
+    if first == second:
+        # off and on again, the blink tells the bird the trial has moved on
+        await decider.cue(params['init_position'], 'off')
+        cued = await decider.cue(cue2, params['cue_color'])
+    else:
+        # first cue off and second on together
+        confirmed = await decider.transact({first: {'led_state': 'off'},
+                                            second: {'led_state': params['cue_color']}},
+                                           current=True)
+        cued = confirmed[second].stamp
+
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={second_input: True},
+                                                        timeout=None,
+                                                        since=cued)
     await decider.cue(cue2, 'off')
 
     await decider.feed(delay=params['feed_delay'])
@@ -292,29 +281,18 @@ async def block4_auton():
 
     await_input = peck_parse(params['init_position'], 'r')
 
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == await_input):
-                return True
-        return False
-
     await decider.scry('peck-keys',
-                       condition=resp_check,
+                       condition={await_input: True},
                        timeout=None)
 
     cue2 = pick(params['response_position'])
     second_input = peck_parse(cue2, 'r')
-    await decider.cue(cue2, params['cue_color'])
-
-    def resp_check(key_state):
-        for k, v in key_state.items():
-            if v & (k == second_input):
-                return True
-        return False
+    cued = await decider.cue(cue2, params['cue_color'])
 
-    _, responded, msg, rtime = await decider.scry('peck-keys',
-                                                  condition=resp_check,
-                                                  timeout=None)
+    _, responded, msg, rtime, *_ = await decider.scry('peck-keys',
+                                                        condition={second_input: True},
+                                                        timeout=None,
+                                                        since=cued)
     await decider.cue(cue2, 'off')
 
     await decider.feed(delay=params['feed_delay'])
@@ -339,12 +317,12 @@ def pick(group):
     return group[int(random.random() // (1 / len(group)))]
 
 
-if __name__ == 'shape':
+if (__name__ == 'shape') and not supervised():
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.warning("Keyboard Interrupt Detected, shutting down.")
         if not args.no_notify:
-            slack(f"{IDENTITY} {__name__} client was manually shut down.", usr=args.user)
+            slack(f"{current().identity} {__name__} client was manually shut down.", usr=args.user)
         sys.exit("Keyboard Interrupt Detected, shutting down.")
 
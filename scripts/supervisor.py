@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+import os
+import sys
+import yaml
+import asyncio
+import logging
+import argparse
+import multiprocessing
+from lib.logging import lincoln
+from lib.fleet import herd, Shepherd
+from lib.vigil import run
+__name__ = 'supervisor'
+
+p = argparse.ArgumentParser(description="Run the experiment scripts of several boxes in one process")
+p.add_argument("rigs", help="YAML file listing the boxes, see docs/running.md")
+p.add_argument('--workers', help="worker processes to shard the boxes across, 0 for one per core."
+                                 " With 1, the boxes run in this process",
+               action='store', type=int, default=1)
+p.add_argument('--log_level', default='INFO')
+args = p.parse_args()
+
+# worker processes load this script anew, each gets a log file of its own
+worker = multiprocessing.current_process().name != 'MainProcess'
+lincoln(log=f"{__name__}_{os.getpid()}.log" if worker else f"{__name__}.log", level=args.log_level)
+logger = logging.getLogger('main')
+
+
+async def main():
+    with open(args.rigs, 'r') as file:
+        entries = yaml.safe_load(file)['rigs']
+    workers = args.workers or os.cpu_count()
+    if workers == 1:
+        boxes = herd(entries)
+        await asyncio.gather(*[task for _rig, _module, task in boxes.values()])
+    else:
+        await Shepherd(entries, min(workers, len(entries))).run()
+
+
+if (__name__ == 'supervisor') and not worker:
+    try:
+        run(main())
+    except KeyboardInterrupt:
+        logger.warning("Keyboard Interrupt Detected, shutting down.")
+        sys.exit("Keyboard Interrupt Detected, shutting down.")
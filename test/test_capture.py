@@ -0,0 +1,67 @@
+"""
+Checks that a PUB capture reads back as written, and replays with the intervals it was recorded with
+    python -m unittest discover -s test
+"""
+import os
+import sys
+import time
+import tempfile
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib.capture import Capture, Palantir, frames
+
+RECORDED = [(1000.0, b'state/peck-keys', b'\x01'),
+            (1000.25, b'state/house-light', b'\x02\x03'),
+            (1003.5, b'state/peck-keys', b'')]
+
+
+class Listener:
+    """
+    Stands in for a Sauron, keeping every frame it is given
+    """
+    def __init__(self):
+        self.taken = []
+
+    def wake(self):
+        pass
+
+    def take(self, topic, msg, received):
+        self.taken.append((received, topic, msg))
+
+
+class TestCapture(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'capture.bin')
+        capture = Capture(self.path)
+        for received, topic, msg in RECORDED:
+            capture.write(topic, msg, received)
+        capture.close()
+
+    async def asyncTearDown(self):
+        self.directory.cleanup()
+
+    async def test_frames(self):
+        self.assertEqual(list(frames(self.path)), RECORDED)
+
+    async def test_truncated(self):
+        with open(self.path, 'ab') as file:
+            file.write(b'\x00' * 5)
+        self.assertEqual(list(frames(self.path)), RECORDED)
+
+    async def test_replay_intervals(self):
+        listener = Listener()
+        before = time.time()
+        self.assertEqual(await Palantir(self.path, speed=None).replay(listener), len(RECORDED))
+        after = time.time()
+        self.assertEqual([(topic, msg) for _, topic, msg in listener.taken],
+                         [(topic, msg) for _, topic, msg in RECORDED])
+        # the first frame is received as the replay starts, the rest as far after it as they were recorded
+        first = listener.taken[0][0]
+        self.assertTrue(before <= first <= after)
+        for (received, _, _), (recorded, _, _) in zip(listener.taken, RECORDED):
+            self.assertAlmostEqual(received - first, recorded - RECORDED[0][0], places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Checks Courier's batching and its handling of Decide-Host's replies against a local stand-in for Decide-Host
+    python -m unittest discover -s test
+"""
+import os
+import sys
+import asyncio
+import unittest
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import aiohttp
+from aiohttp import web
+import lib.logging  # registers the client's log levels, e.g. logger.dispatch
+from lib import inform
+
+
+class StandIn:
+    """
+    Decide-Host's trial and event endpoints, recording every request. The reply to a batch is
+    a function given its records, returning (status, json body). Without bulk, posting a batch
+    gets a 404, or with bulk='get' a 405 as the batch endpoint only answers GET
+    """
+    def __init__(self, bulk=True):
+        self.batches = []
+        self.singles = []
+        self.reply = lambda records: (201, {'failed': []})
+        app = web.Application()
+        if bulk == 'get':
+            app.router.add_get('/{target}/batch/', self.batch)
+        elif bulk:
+            app.router.add_post('/{target}/batch/', self.batch)
+        app.router.add_post('/{target}/', self.single)
+        self.runner = web.AppRunner(app)
+        self.url = None
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def batch(self, request):
+        records = await request.json()
+        self.batches.append(records)
+        status, body = self.reply(records)
+        return web.json_response(body, status=status)
+
+    async def single(self, request):
+        self.singles.append(await request.json())
+        return web.json_response({}, status=201)
+
+
+class CourierTest(unittest.IsolatedAsyncioTestCase):
+    bulk = True
+
+    async def asyncSetUp(self):
+        self.host = StandIn(bulk=self.bulk)
+        await self.host.start()
+        self.dropped = []
+        self.patches = [mock.patch.object(inform, 'CONTACT_HOST', True),
+                        mock.patch.object(inform, 'HIVEMIND', self.host.url),
+                        mock.patch.object(inform, 'session', aiohttp.ClientSession()),
+                        mock.patch.object(inform, 'log_dropped',
+                                          lambda target, msg: self.dropped.append(msg)),
+                        mock.patch.object(inform, 'post_dropped', lambda target: None)]
+        for patch in self.patches:
+            patch.start()
+        self.courier = inform.Courier('events', size=4, deadline=0.2, identity='test-rig')
+
+    async def asyncTearDown(self):
+        await inform.session.close()
+        for patch in reversed(self.patches):
+            patch.stop()
+        await self.host.stop()
+
+    @staticmethod
+    def records(n):
+        return [{'event': i} for i in range(n)]
+
+
+class TestBatching(CourierTest):
+    async def test_size(self):
+        queue = asyncio.Queue()
+        for record in self.records(10):
+            queue.put_nowait(record)
+        task = asyncio.create_task(self.courier.deliver(queue))
+        await asyncio.sleep(0.1)
+        # two full batches go at once, the last two records wait for the deadline
+        self.assertEqual([len(batch) for batch in self.host.batches], [4, 4])
+        await asyncio.sleep(0.3)
+        task.cancel()
+        self.assertEqual([len(batch) for batch in self.host.batches], [4, 4, 2])
+        self.assertEqual([record['event'] for batch in self.host.batches for record in batch], list(range(10)))
+        self.assertTrue(all(record['addr'] == 'test-rig' and 'time' in record
+                            for batch in self.host.batches for record in batch))
+        self.assertEqual(self.dropped, [])
+
+    async def test_deadline(self):
+        queue = asyncio.Queue()
+        task = asyncio.create_task(self.courier.deliver(queue))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        queue.put_nowait({'event': 0})
+        await asyncio.sleep(0.05)
+        queue.put_nowait({'event': 1})
+        while not self.host.batches:
+            await asyncio.sleep(0.01)
+        waited = loop.time() - start
+        task.cancel()
+        self.assertEqual([len(batch) for batch in self.host.batches], [2])
+        self.assertGreaterEqual(waited, 0.2)
+        self.assertLess(waited, 0.5)
+
+
+class TestReplies(CourierTest):
+    async def test_accepted(self):
+        await self.courier.post(self.records(3))
+        self.assertEqual(len(self.host.batches), 1)
+        self.assertEqual(self.dropped, [])
+
+    async def test_partial_failure(self):
+        self.host.reply = lambda records: (207, {'failed': [2, 0, 2]})
+        batch = self.records(4)
+        await self.courier.post(batch)
+        self.assertEqual([msg['event'] for msg in self.dropped], [0, 2])
+
+    async def test_error(self):
+        self.host.reply = lambda records: (500, {})
+        await self.courier.post(self.records(3))
+        self.assertEqual([msg['event'] for msg in self.dropped], [0, 1, 2])
+
+    async def test_malformed(self):
+        # indices out of range, of the wrong type, or not in a list leave no telling what was logged
+        for failed in [[4], [-1], ['1'], [1.0], [True], 1, {'0': 'oops'}]:
+            with self.subTest(failed=failed):
+                self.dropped.clear()
+                self.host.reply = lambda records: (207, {'failed': failed})
+                await self.courier.post(self.records(4))
+                self.assertEqual([msg['event'] for msg in self.dropped], [0, 1, 2, 3])
+
+    async def test_no_body(self):
+        self.host.reply = lambda records: (201, None)
+        await self.courier.post(self.records(3))
+        self.assertEqual(self.dropped, [])
+
+
+class TestFallback(CourierTest):
+    bulk = False
+
+    async def test_single_posts(self):
+        await self.courier.post(self.records(3))
+        self.assertFalse(self.courier.bulk)
+        await self.courier.post(self.records(2))
+        # the first batch is sent again record by record, later ones go straight to single posts
+        self.assertEqual([msg['event'] for msg in self.host.singles], [0, 1, 2, 0, 1])
+        self.assertEqual(self.host.batches, [])
+        self.assertEqual(self.dropped, [])
+
+
+class TestMethodFallback(CourierTest):
+    bulk = 'get'
+
+    async def test_single_posts(self):
+        await self.courier.post(self.records(2))
+        self.assertFalse(self.courier.bulk)
+        self.assertEqual([msg['event'] for msg in self.host.singles], [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Checks that the generated decoders in lib/decrypt.py give the same dicts as MessageToDict
+    python -m unittest discover -s test
+"""
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib.decrypt import compile_decoder, decode, messages, read_topic, registry
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.json_format import MessageToDict
+
+# none of the component protos has a 64-bit field yet, so one is built here for every 64-bit type
+WIDE_TYPES = {'int64': FieldDescriptor.TYPE_INT64, 'uint64': FieldDescriptor.TYPE_UINT64,
+              'sint64': FieldDescriptor.TYPE_SINT64, 'fixed64': FieldDescriptor.TYPE_FIXED64,
+              'sfixed64': FieldDescriptor.TYPE_SFIXED64}
+# past 2**53, where a double would lose them, and the extremes of each type
+WIDE_VALUES = {'int64': [2**53 + 1, -2**63], 'uint64': [2**64 - 1], 'sint64': [-2**53 - 1, 2**63 - 1],
+               'fixed64': [2**63 + 7], 'sfixed64': [-2**62 - 3]}
+
+
+def wide_message_class():
+    proto = descriptor_pb2.FileDescriptorProto(name='test_wide.proto', package='test_wide', syntax='proto3')
+    message = proto.message_type.add(name='WideState')
+    message.field.add(name='running', number=1, type=FieldDescriptor.TYPE_BOOL,
+                      label=FieldDescriptor.LABEL_OPTIONAL)
+    for number, (name, field_type) in enumerate(WIDE_TYPES.items(), start=2):
+        message.field.add(name=f'{name}_field', number=number, type=field_type,
+                          label=FieldDescriptor.LABEL_OPTIONAL)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto)
+    descriptor = pool.FindMessageTypeByName('test_wide.WideState')
+    try:
+        return message_factory.GetMessageClass(descriptor)
+    except AttributeError:  # protobuf before 4.21
+        return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+def populated(message_class):
+    """
+    An instance of message_class with every plain scalar field set away from its default
+    """
+    message = message_class()
+    for field in message_class.DESCRIPTOR.fields:
+        if field.type == FieldDescriptor.TYPE_BOOL:
+            setattr(message, field.name, True)
+        elif field.type == FieldDescriptor.TYPE_STRING:
+            setattr(message, field.name, 'stimulus.wav')
+        elif field.type in (FieldDescriptor.TYPE_INT32, FieldDescriptor.TYPE_SINT32,
+                            FieldDescriptor.TYPE_SFIXED32):
+            setattr(message, field.name, -2**31)
+        elif field.type in (FieldDescriptor.TYPE_UINT32, FieldDescriptor.TYPE_FIXED32):
+            setattr(message, field.name, 2**32 - 1)
+        elif field.type in WIDE_TYPES.values():
+            setattr(message, field.name, 2**53 + 1)
+    return message
+
+
+def expected(message):
+    return MessageToDict(message, including_default_value_fields=True, preserving_proto_field_name=True)
+
+
+class TestDecode(unittest.TestCase):
+    def test_defaults(self):
+        for message_class in messages.values():
+            with self.subTest(message=message_class.__name__):
+                self.assertEqual(decode(message_class()), expected(message_class()))
+
+    def test_populated(self):
+        for message_class in messages.values():
+            with self.subTest(message=message_class.__name__):
+                message = populated(message_class)
+                self.assertEqual(decode(message), expected(message))
+
+    def test_generated(self):
+        """
+        Every component message is plain, so should get a generated decoder rather than the fallback
+        """
+        for message_class in messages.values():
+            with self.subTest(message=message_class.__name__):
+                self.assertEqual(compile_decoder(message_class).__name__, 'decode')
+
+    def test_wide_fields(self):
+        message_class = wide_message_class()
+        decoder = compile_decoder(message_class)
+        self.assertEqual(decoder.__name__, 'decode')
+        self.assertEqual(decoder(message_class()), expected(message_class()))
+        for name, values in WIDE_VALUES.items():
+            for value in values:
+                with self.subTest(field=name, value=value):
+                    message = message_class(running=True, **{f'{name}_field': value})
+                    self.assertEqual(decoder(message), expected(message))
+                    self.assertEqual(decoder(message)[f'{name}_field'], str(value))
+
+
+class TestTopics(unittest.TestCase):
+    def test_state(self):
+        for component in registry:
+            with self.subTest(component=component):
+                self.assertEqual(read_topic(f"state/{component}".encode('utf-8')), ('state', component))
+
+    def test_unhandled(self):
+        # components publish on error and log topics too, which have no message in the registry
+        for topic in [b'error/peck-keys', b'log/house-light', b'state/unknown-thing', b'state', b'']:
+            with self.subTest(topic=topic):
+                self.assertIsNone(read_topic(topic))
+
+
+if __name__ == '__main__':
+    unittest.main()
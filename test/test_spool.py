@@ -0,0 +1,73 @@
+"""
+Checks when the spool of dropped records fsyncs, and that replayed records are skipped
+    python -m unittest discover -s test
+"""
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+from unittest import mock
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from lib import spool
+from lib.spool import Spool
+
+
+class SpoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'dropped_events.jsonl')
+        self.fsyncs = 0
+        self.patch = mock.patch.object(spool.os, 'fsync', self.count)
+        self.patch.start()
+
+    async def asyncTearDown(self):
+        self.patch.stop()
+        self.directory.cleanup()
+
+    def count(self, fd):
+        self.fsyncs += 1
+
+    async def test_sync_every(self):
+        dropped = Spool(self.path, sync_every=4, sync_interval=60)
+        for i in range(9):
+            dropped.append({'event': i})
+        self.assertEqual(self.fsyncs, 2)
+        self.assertEqual(dropped.unsynced, 1)
+
+    async def test_end_of_burst(self):
+        # the last records of a burst are synced within sync_interval, with no append to follow them
+        dropped = Spool(self.path, sync_every=32, sync_interval=0.1)
+        for i in range(5):
+            dropped.append({'event': i})
+        self.assertEqual(self.fsyncs, 0)
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.fsyncs, 1)
+        self.assertEqual(dropped.unsynced, 0)
+        self.assertIsNone(dropped.timer)
+
+    async def test_one_timer(self):
+        # a sync for another reason takes the place of the pending one
+        dropped = Spool(self.path, sync_every=3, sync_interval=0.1)
+        for i in range(3):
+            dropped.append({'event': i})
+        self.assertEqual(self.fsyncs, 1)
+        self.assertIsNone(dropped.timer)
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.fsyncs, 1)
+
+    async def test_pending(self):
+        dropped = Spool(self.path)
+        for i in range(4):
+            dropped.append({'event': i})
+        records = list(dropped.pending())
+        self.assertEqual([record['event'] for _, record in records], [0, 1, 2, 3])
+        dropped.commit(records[1][0])
+        self.assertEqual([record['event'] for _, record in dropped.pending()], [2, 3])
+        dropped.commit(records[-1][0])
+        self.assertEqual(list(dropped.pending()), [])
+        self.assertEqual(dropped.backlog(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()